@@ -0,0 +1,292 @@
+'''
+Semantic cache of answers to questions about a memoir.
+
+Questions are normalized to a set of stemmed content words plus their
+question words, relations (before, after, during, ...) and negation, so
+"How did the lifeguard save Alan at Jones Beach?" and "how did the
+lifeguards help alan at jones beach" are compared by the words that carry
+meaning rather than their exact text. A new question is served the stored
+answer of the most similar earlier question about the same memoir if both
+ask the same way (the same question words and relations, both negated or
+neither) and their content words overlap enough (Jaccard similarity), or,
+when an embedder is given, if their embeddings are close enough (cosine
+similarity). Questions of three content words or fewer must match exactly,
+since one shared word is already a large overlap. Rewordings that change
+the question word ("What did the lifeguard do for Alan?" and "How did the
+lifeguard help Alan?") are deliberately not matched.
+
+Every entry records a fingerprint of the memoir's chapters (their content
+hashes), and entries whose fingerprint no longer matches are dropped on
+the next lookup, so answers never outlive the text they came from.
+Entries also record the LLM backend that wrote them, and are only served
+to the same backend.
+Entries live in memory and in an SQLite file next to memoirs.db, so the
+read-only Streamlit connection can still use the cache.
+'''
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from text import STOPWORDS, stem, tokenize
+
+# A stored answer served for a question, with the question it was stored for
+CachedAnswer = namedtuple('CachedAnswer', ['answer', 'chunk_ids', 'question', 'similarity'])
+
+# Words that change what a question asks for. They are kept out of the
+# content words and must be the same for two questions to match.
+QUESTION_WORDS = frozenset('how what when where which who whom whose why'.split())
+NEGATIONS = frozenset('cannot never no nor not'.split())
+# "before the crash" and "after the crash" ask about different things
+RELATIONS = frozenset('above after against before below between during over under until while'.split())
+
+# Ignored in questions; unlike text.STOPWORDS this keeps the
+# question words, negations and relations
+CACHE_STOPWORDS = STOPWORDS - QUESTION_WORDS - NEGATIONS - RELATIONS
+
+# Fewer content words than this only match identical sets
+MIN_JACCARD_WORDS = 4
+
+def normalize_question(text):
+    '''
+    Sorted, de-duplicated stems of the content words of a question, plus
+    its question words, relations (before, after, during, ...) and "not"
+    if it is negated ("didn't" included).
+    '''
+    terms = set()
+    for token in tokenize(text, drop_stopwords=False):
+        if token in NEGATIONS or token.endswith("n't"):
+            terms.add('not')
+        elif token in QUESTION_WORDS or token in RELATIONS:
+            terms.add(token)
+        elif token not in CACHE_STOPWORDS:
+            terms.add(stem(token))
+    return tuple(sorted(terms))
+
+def split_question(normalized):
+    '''
+    (how the question asks, content words) of a normalized question.
+    '''
+    frame = tuple(
+        term for term in normalized if term in QUESTION_WORDS or term in RELATIONS or term == 'not'
+    )
+    return frame, tuple(term for term in normalized if term not in frame)
+
+def memoir_fingerprint(conn, memoir_id):
+    '''
+    Hash of a memoir's chapters that changes whenever one is added,
+    edited or removed.
+    '''
+    digest = hashlib.sha256()
+    for chunk_id, content_hash in conn.execute(
+        'SELECT id, content_hash FROM memoir_chunks WHERE memoir_id = ? ORDER BY id', (memoir_id,)
+    ):
+        digest.update(f'{chunk_id}:{content_hash}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+def jaccard(a, b):
+    a, b = set(a), set(b)
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+class AnswerCache:
+    '''
+    Per-memoir answer cache with similarity lookup.
+    Safe to share between threads.
+    '''
+
+    def __init__(self, db_path='answer_cache.db', threshold=0.65, embedder=None,
+                 embedding_threshold=0.9, max_entries=500):
+        self.db_path = db_path
+        self.threshold = threshold
+        self.embedder = embedder
+        self.embedding_threshold = embedding_threshold
+        self.max_entries = max_entries
+        # (backend, memoir_id) -> (fingerprint, [entry dicts]), most recently used last
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        self.hits = 0
+        self.misses = 0
+
+    def _disk(self):
+        '''
+        Opens the SQLite tier on first use.
+        '''
+        if self._conn is None and self.db_path:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(answer_cache)')]
+            if columns and 'backend' not in columns:
+                # Files from before backends were recorded may hold stub answers
+                self._conn.execute('DROP TABLE answer_cache')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS answer_cache (
+                    id INTEGER PRIMARY KEY,
+                    backend TEXT,
+                    memoir_id INTEGER,
+                    fingerprint TEXT,
+                    question TEXT,
+                    answer TEXT,
+                    chunk_ids TEXT,
+                    accessed_at REAL
+                )
+            ''')
+            self._conn.execute('DROP INDEX IF EXISTS answer_cache_memoir')
+            self._conn.execute('''
+                CREATE INDEX IF NOT EXISTS answer_cache_backend_memoir
+                ON answer_cache (backend, memoir_id, fingerprint)
+            ''')
+            self._conn.commit()
+        return self._conn
+
+    def _load(self, backend, memoir_id, fingerprint):
+        '''
+        A backend's entries for a memoir at this fingerprint, dropping
+        stale ones.
+        '''
+        cached = self._entries.get((backend, memoir_id))
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+
+        entries = []
+        conn = self._disk()
+        if conn is not None:
+            conn.execute(
+                'DELETE FROM answer_cache WHERE backend = ? AND memoir_id = ? AND fingerprint != ?',
+                (backend, memoir_id, fingerprint)
+            )
+            conn.commit()
+            rows = conn.execute('''
+                SELECT id, question, answer, chunk_ids FROM answer_cache
+                WHERE backend = ? AND memoir_id = ? AND fingerprint = ?
+                ORDER BY accessed_at
+            ''', (backend, memoir_id, fingerprint)).fetchall()
+            entries = [self._entry(row[1], row[2], json.loads(row[3]), row[0]) for row in rows]
+        self._entries[(backend, memoir_id)] = (fingerprint, entries)
+        return entries
+
+    def _entry(self, question, answer, chunk_ids, row_id=None):
+        normalized = normalize_question(question)
+        vector = self._embed(normalized)
+        return {
+            'id': row_id,
+            'question': question,
+            'normalized': normalized,
+            'vector': vector,
+            'answer': answer,
+            'chunk_ids': chunk_ids,
+        }
+
+    def _embed(self, normalized):
+        '''
+        Embedding of the content words, or None without an embedder.
+        '''
+        if self.embedder is None:
+            return None
+        return self.embedder.embed([' '.join(split_question(normalized)[1])])[0]
+
+    def _similarity(self, entry, normalized, vector):
+        if normalized == entry['normalized']:
+            return 1.0
+        frame, words = split_question(normalized)
+        entry_frame, entry_words = split_question(entry['normalized'])
+        if frame != entry_frame:
+            return 0.0
+        if vector is not None:
+            return float(vector @ entry['vector'])
+        if min(len(words), len(entry_words)) < MIN_JACCARD_WORDS:
+            return 0.0
+        return jaccard(words, entry_words)
+
+    def lookup(self, memoir_id, fingerprint, question, backend=''):
+        '''
+        Returns a CachedAnswer for the most similar question the backend
+        answered about this memoir at this fingerprint, or None if none is
+        close enough.
+        '''
+        normalized = normalize_question(question)
+        if not normalized:
+            return None
+        vector = self._embed(normalized)
+        threshold = self.embedding_threshold if vector is not None else self.threshold
+        with self._lock:
+            entries = self._load(backend, memoir_id, fingerprint)
+            best, best_similarity = None, 0.0
+            for entry in entries:
+                similarity = self._similarity(entry, normalized, vector)
+                if similarity > best_similarity:
+                    best, best_similarity = entry, similarity
+            if best is None or best_similarity < threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            entries.remove(best)
+            entries.append(best)
+            conn = self._disk()
+            if conn is not None and best['id'] is not None:
+                conn.execute('UPDATE answer_cache SET accessed_at = ? WHERE id = ?', (time.time(), best['id']))
+                conn.commit()
+            return CachedAnswer(best['answer'], list(best['chunk_ids']), best['question'], best_similarity)
+
+    def store(self, memoir_id, fingerprint, question, answer, chunk_ids=(), backend=''):
+        '''
+        Remembers the backend's answer to a question, evicting the least
+        recently used entries of the memoir beyond max_entries.
+        '''
+        if not self.max_entries or not normalize_question(question):
+            return
+        entry = self._entry(question, answer, list(chunk_ids))
+        with self._lock:
+            entries = self._load(backend, memoir_id, fingerprint)
+            conn = self._disk()
+            if conn is not None:
+                entry['id'] = conn.execute('''
+                    INSERT INTO answer_cache
+                        (backend, memoir_id, fingerprint, question, answer, chunk_ids, accessed_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (backend, memoir_id, fingerprint, question, answer, json.dumps(entry['chunk_ids']),
+                      time.time())).lastrowid
+            entries.append(entry)
+            evicted = entries[:-self.max_entries]
+            del entries[:-self.max_entries]
+            if conn is not None:
+                conn.executemany(
+                    'DELETE FROM answer_cache WHERE id = ?', [(old['id'],) for old in evicted]
+                )
+                conn.commit()
+
+    def invalidate(self, memoir_id=None):
+        '''
+        Drops the entries of one memoir, or of every memoir.
+        '''
+        with self._lock:
+            conn = self._disk()
+            if memoir_id is None:
+                self._entries.clear()
+                if conn is not None:
+                    conn.execute('DELETE FROM answer_cache')
+            else:
+                for key in [key for key in self._entries if key[1] == memoir_id]:
+                    del self._entries[key]
+                if conn is not None:
+                    conn.execute('DELETE FROM answer_cache WHERE memoir_id = ?', (memoir_id,))
+            if conn is not None:
+                conn.commit()
+
+    def stats(self):
+        '''
+        Hit/miss counters for monitoring.
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': sum(len(entries) for _, entries in self._entries.values()),
+            }
@@ -1,9 +1,31 @@
-import sqlite3
+import os
+from collections import OrderedDict
 import streamlit as st
-from memoir_rag import search_across_chunks
+from image_store import thumbnail_path
+from memoir_rag import list_memoirs, search_library, stream_search_across_chunks
+from storage import connect, initialize_db
+from tracing import recent_traces
 
-def load_memoir_from_db(conn, memoir_id):
-    cursor = conn.cursor()
+DB_PATH = 'memoirs.db'
+
+@st.cache_resource
+def get_connection(db_path=DB_PATH):
+    '''
+    One read-only connection shared by every rerun and session. The schema
+    is migrated first; WAL lets it read while an ingest is writing.
+    '''
+    initialize_db(db_path).close()
+    return connect(db_path, readonly=True, check_same_thread=False)
+
+def get_data_version(conn):
+    '''
+    Changes whenever another connection (e.g. an ingest) commits to the database.
+    '''
+    return conn.execute('PRAGMA data_version').fetchone()[0]
+
+@st.cache_data
+def load_memoir_from_db(_conn, memoir_id, data_version):
+    cursor = _conn.cursor()
     cursor.execute('''
         SELECT memoirs.author, memoir_chunks.content, memoir_chunks.image_path
         FROM memoirs
@@ -12,30 +34,130 @@ def load_memoir_from_db(conn, memoir_id):
     ''', (memoir_id,))
     return cursor.fetchall()
 
-def display_memoir_content(memoir_data):
+@st.cache_data
+def load_catalog(_conn, data_version):
+    '''
+    The memoir catalog, reloaded only when the database changes.
+    '''
+    return [memoir._asdict() for memoir in list_memoirs(_conn)]
+
+@st.cache_data
+def load_image_bytes(image_path, data_version):
+    '''
+    Reads a chapter image once per database version instead of on every rerun,
+    preferring its small WebP thumbnail when one was made at ingest.
+    '''
+    thumbnail = thumbnail_path(image_path)
+    if os.path.exists(thumbnail):
+        image_path = thumbnail
+    if not os.path.exists(image_path):
+        return None
+    with open(image_path, 'rb') as image_file:
+        return image_file.read()
+
+# Number of answers kept by get_answer_cache
+MAX_CACHED_ANSWERS = 256
+
+@st.cache_resource
+def get_answer_cache():
+    '''
+    Answers already given, keyed by (memoir_id, question, data_version),
+    oldest first.
+    '''
+    return OrderedDict()
+
+def display_memoir_content(memoir_data, data_version):
     for author, chunk, image_path in memoir_data:
-        if image_path:
-                st.image(
-                image_path,
+        image_bytes = load_image_bytes(image_path, data_version) if image_path else None
+        if image_bytes:
+            st.image(
+                image_bytes,
                 caption="Generated by Monster API",
                 use_container_width=True
             )
         st.write(chunk)
 
+def display_debug_panel(n=10):
+    '''
+    Sidebar table of per-stage latencies for the last n questions.
+    '''
+    rows = []
+    for trace in recent_traces.recent(n):
+        row = {
+            'question': trace.attributes.get('question'),
+            'total_ms': round(trace.duration_ms or 0.0, 1),
+        }
+        for stage, duration_ms in trace.stage_durations().items():
+            row[f'{stage}_ms'] = round(duration_ms, 1)
+        for flag in ('prompt_tokens', 'completion_tokens', 'cache_hits', 'fallback_taken'):
+            row[flag] = trace.attributes.get(flag)
+        rows.append(row)
+    st.sidebar.subheader("Pipeline timings")
+    if rows:
+        st.sidebar.dataframe(rows)
+    else:
+        st.sidebar.write("No questions answered yet.")
+
 def handle_user_question(conn, user_input, memoir_id, author):
-    return search_across_chunks(conn, user_input, memoir_id, author)
+    return stream_search_across_chunks(conn, user_input, memoir_id, author)
+
+def pick_memoir(catalog):
+    '''
+    Sidebar picker over the memoir catalog. Returns the chosen memoir or None.
+    '''
+    if not catalog:
+        return None
+    memoirs = {memoir['id']: memoir for memoir in catalog}
+    memoir_id = st.sidebar.selectbox(
+        "Memoir",
+        list(memoirs),
+        format_func=lambda memoir_id: f"{memoirs[memoir_id]['title']} by {memoirs[memoir_id]['author']}",
+    )
+    return memoirs[memoir_id]
+
+def display_library_search(conn):
+    '''
+    Sidebar search over the passages of every memoir in the library.
+    '''
+    keywords = st.sidebar.text_input("Search all memoirs:")
+    if not keywords:
+        return
+    results, message = search_library(conn, keywords, k=5)
+    if message:
+        st.sidebar.write(message)
+    for result in results or []:
+        st.sidebar.markdown(f"**{result.title}** by {result.author}: {result.snippet}")
 
 def main():
-    st.title("Alan's Memoir: Interactive Q&A")
-    conn = sqlite3.connect('memoirs.db')
-    memoir_id = 1 # Modify per the memoir ID you want to interact with
-    memoir_data = load_memoir_from_db(conn, memoir_id)
-    display_memoir_content(memoir_data)
+    conn = get_connection()
+    data_version = get_data_version(conn)
+    catalog = load_catalog(conn, data_version)
+    memoir = pick_memoir(catalog)
+    if memoir is None:
+        st.title("Memoir Library")
+        st.write("No memoirs have been saved yet. Add one with `python3 memoir_rag.py --save`.")
+        return
+    st.title(f"{memoir['title']}: Interactive Q&A")
+    if len(catalog) > 1:
+        display_library_search(conn)
+    memoir_id = memoir['id']
+    memoir_data = load_memoir_from_db(conn, memoir_id, data_version)
+    display_memoir_content(memoir_data, data_version)
     author = memoir_data[0][0] if memoir_data else None
     user_input = st.text_input("Ask a question about the memoir:")
     if user_input and author:
-        response = handle_user_question(conn, user_input, memoir_id, author)
-        st.write(f"**Answer:** {response}")
+        st.write("**Answer:**")
+        answers = get_answer_cache()
+        key = (memoir_id, user_input.strip(), data_version)
+        if key in answers:
+            st.write(answers[key])
+        else:
+            answers[key] = st.write_stream(handle_user_question(conn, user_input, memoir_id, author))
+            while len(answers) > MAX_CACHED_ANSWERS:
+                answers.popitem(last=False)
+
+    if st.sidebar.checkbox("Show pipeline timings"):
+        display_debug_panel()
 
 if __name__ == "__main__":
     main()
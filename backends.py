@@ -0,0 +1,602 @@
+'''
+LLM and image generation backends.
+
+memoir_rag talks to providers only through the small interfaces defined
+here. GroqBackend and MonsterBackend wrap the live APIs; StubLLMBackend and
+StubImageBackend are offline, deterministic stand-ins with configurable
+latency, used to benchmark the retrieval and ingestion paths and to run the
+evaluator without API keys or network access. The stub image backend serves
+its images from a local HTTP server so the download step is exercised too,
+and StubGroqServer serves the stub LLM over Groq's HTTP API so the real
+client, rate limiting and retries can be tested offline.
+
+The live Groq backend is wrapped in RateLimitedLLMBackend, which keeps
+requests within the per-model limits, retries rate-limited and failed
+requests, and shares one response between concurrent identical requests.
+
+Set MEMOIR_BACKEND=stub to use the stubs everywhere.
+'''
+
+import hashlib
+import json
+import os
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+from rate_limit import RateLimiter, SingleFlight, backoff_delay, is_retryable, retry_after
+
+# Text of a completion plus the token usage reported for it (None if unknown)
+Completion = namedtuple('Completion', ['text', 'prompt_tokens', 'completion_tokens'])
+
+################################################################################
+# Interfaces
+################################################################################
+
+class LLMBackend:
+    '''
+    Chat completion provider used by run_llm, stream_llm and the guard.
+    name identifies the provider in cache keys, so completions from one
+    backend are never served in place of another's. retries_transient is
+    True when the backend already retries rate limits and server errors,
+    so callers should not retry those again.
+    '''
+
+    name = 'llm'
+    retries_transient = False
+
+    def complete(self, system, user, model, seed=None):
+        '''
+        Returns a Completion for one system + user exchange.
+        '''
+        raise NotImplementedError
+
+    def stream(self, system, user, model, seed=None):
+        '''
+        Yields the completion as text deltas, then returns its Completion
+        (the generator's return value) so callers can record token usage.
+        '''
+        completion = self.complete(system, user, model, seed)
+        yield completion.text
+        return completion
+
+    def moderate(self, user_input, model):
+        '''
+        Returns a Completion whose text is the raw safety verdict for
+        user_input, e.g. "safe" or "unsafe\\nS1".
+        '''
+        raise NotImplementedError
+
+class ImageBackend:
+    '''
+    Text-to-image provider used by generate_image. name identifies the
+    provider in image keys, like LLMBackend.name.
+    '''
+
+    name = 'image'
+
+    def generate(self, model, input_data):
+        '''
+        Returns a list of URLs of generated images.
+        '''
+        raise NotImplementedError
+
+################################################################################
+# Live providers
+################################################################################
+
+class GroqBackend(LLMBackend):
+    '''
+    Groq chat completions. The client is built on first use. base_url
+    points it at another server (e.g. a StubGroqServer); max_retries=0
+    leaves retrying to a RateLimitedLLMBackend around it.
+    '''
+
+    def __init__(self, api_key=None, base_url=None, max_retries=2):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.name = 'groq' if base_url is None else f'groq@{base_url}'
+        # The Groq client retries 429s and 5xx responses itself
+        self.retries_transient = max_retries > 0
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import groq
+                self._client = groq.Groq(
+                    api_key=self.api_key or os.environ.get("GROQ_API_KEY"),
+                    base_url=self.base_url,
+                    max_retries=self.max_retries,
+                )
+            return self._client
+
+    def _messages(self, system, user):
+        return [
+            {
+                'role': 'system',
+                'content': system,
+            },
+            {
+                "role": "user",
+                "content": user,
+            }
+        ]
+
+    def _completion(self, chat_completion):
+        usage = getattr(chat_completion, 'usage', None)
+        return Completion(
+            chat_completion.choices[0].message.content,
+            getattr(usage, 'prompt_tokens', None),
+            getattr(usage, 'completion_tokens', None),
+        )
+
+    def complete(self, system, user, model, seed=None):
+        chat_completion = self.client.chat.completions.create(
+            messages=self._messages(system, user),
+            model=model,
+            seed=seed,
+        )
+        return self._completion(chat_completion)
+
+    def stream(self, system, user, model, seed=None):
+        stream = self.client.chat.completions.create(
+            messages=self._messages(system, user),
+            model=model,
+            seed=seed,
+            stream=True,
+        )
+        parts = []
+        usage = None
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
+            # Groq reports usage on the final chunk, under x_groq
+            x_groq = getattr(chunk, 'x_groq', None)
+            usage = getattr(chunk, 'usage', None) or getattr(x_groq, 'usage', None) or usage
+        return Completion(
+            ''.join(parts),
+            getattr(usage, 'prompt_tokens', None),
+            getattr(usage, 'completion_tokens', None),
+        )
+
+    def moderate(self, user_input, model):
+        completion = self.client.chat.completions.create(
+            model=model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": user_input,
+                }
+            ],
+            temperature=0,
+            max_tokens=1024,
+            top_p=1,
+            stop=None,
+        )
+        return self._completion(completion)
+
+def estimate_request_tokens(*texts):
+    '''
+    Rough token count of a request (about four characters per token).
+    '''
+    return sum(len(text or '') for text in texts) // 4 + 1
+
+class RateLimitedLLMBackend(LLMBackend):
+    '''
+    Wraps an LLM backend so that every request waits for its model's
+    requests- and tokens-per-minute budget (see rate_limit.RateLimiter),
+    transient failures are retried with jittered exponential backoff, and
+    a 429 pauses every request to that model until the provider's reset
+    time. Identical complete() and moderate() calls in flight at the same
+    time are sent once and share the response. Safe to share between
+    threads and Streamlit sessions.
+    '''
+
+    def __init__(self, backend, limiter=None, retries=4, backoff=0.5, max_backoff=30.0):
+        self.backend = backend
+        self.limiter = limiter or RateLimiter()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.flights = SingleFlight()
+        self.retried = 0
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    @property
+    def retries_transient(self):
+        return self.retries > 0 or self.backend.retries_transient
+
+    def _wait_before_retry(self, model, error, attempt):
+        '''
+        Re-raises error if it shouldn't be retried, else sleeps before the next attempt.
+        '''
+        if attempt >= self.retries or not is_retryable(error):
+            raise error
+        self.retried += 1
+        delay = retry_after(error)
+        if delay is None:
+            time.sleep(backoff_delay(attempt, self.backoff, self.max_backoff))
+        else:
+            # Every request to the model waits for the reset, plus some
+            # jitter so they don't all retry at the same instant
+            self.limiter.pause(model, delay + backoff_delay(0, self.backoff))
+
+    def _send(self, model, tokens, request):
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire(model, tokens)
+            try:
+                completion = request()
+            except Exception as e:
+                self._wait_before_retry(model, e, attempt)
+                continue
+            if completion.prompt_tokens is not None:
+                self.limiter.record(
+                    model, tokens, completion.prompt_tokens + (completion.completion_tokens or 0)
+                )
+            return completion
+
+    def complete(self, system, user, model, seed=None):
+        tokens = estimate_request_tokens(system, user)
+        return self.flights.do(
+            ('complete', model, system, user, seed),
+            lambda: self._send(model, tokens, lambda: self.backend.complete(system, user, model, seed)),
+        )
+
+    def moderate(self, user_input, model):
+        tokens = estimate_request_tokens(user_input)
+        return self.flights.do(
+            ('moderate', model, user_input),
+            lambda: self._send(model, tokens, lambda: self.backend.moderate(user_input, model)),
+        )
+
+    def stream(self, system, user, model, seed=None):
+        '''
+        Streams are not shared, and only retried until the first delta
+        arrives; after that a failure is passed on to the caller.
+        '''
+        tokens = estimate_request_tokens(system, user)
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire(model, tokens)
+            try:
+                deltas = iter(self.backend.stream(system, user, model, seed))
+                first = next(deltas, None)
+            except Exception as e:
+                self._wait_before_retry(model, e, attempt)
+                continue
+            break
+        completion = None
+        if first is not None:
+            yield first
+            completion = yield from deltas
+        if completion is not None and completion.prompt_tokens is not None:
+            self.limiter.record(model, tokens, completion.prompt_tokens + (completion.completion_tokens or 0))
+        return completion
+
+class MonsterBackend(ImageBackend):
+    '''
+    Monster API text-to-image. The client is built on first use.
+    '''
+
+    name = 'monster'
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from monsterapi import client
+                self._client = client(self.api_key or os.environ.get("MONSTER_API_KEY"))
+            return self._client
+
+    def generate(self, model, input_data):
+        return self.client.generate(model, input_data)['output']
+
+################################################################################
+# Offline stubs
+################################################################################
+
+class Latency:
+    '''
+    Samples simulated latencies in seconds from a seeded distribution:
+    'fixed' (value), 'uniform' (low, high), 'normal' (mean, stdev) or
+    'lognormal' (median, sigma). Negative samples are clamped to zero.
+    '''
+
+    def __init__(self, kind='fixed', *params, seed=0):
+        self.kind = kind
+        self.params = params or (0.0,)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self):
+        with self._lock:
+            if self.kind == 'fixed':
+                value = self.params[0]
+            elif self.kind == 'uniform':
+                value = self._random.uniform(*self.params)
+            elif self.kind == 'normal':
+                value = self._random.gauss(*self.params)
+            elif self.kind == 'lognormal':
+                median, sigma = self.params
+                value = median * self._random.lognormvariate(0, sigma) if median else 0.0
+            else:
+                raise ValueError(f"Unknown latency distribution: {self.kind}")
+        return max(0.0, value)
+
+    def sleep(self):
+        time.sleep(self.sample())
+
+def parse_latency(spec, seed=0):
+    '''
+    Builds a Latency from a spec string like "fixed:0.2" or "lognormal:0.4,0.5".
+    '''
+    kind, _, params = spec.partition(':')
+    return Latency(kind, *(float(value) for value in params.split(',') if value), seed=seed)
+
+STUB_TOKEN_PATTERN = re.compile(r"\w+")
+
+class StubLLMBackend(LLMBackend):
+    '''
+    Deterministic offline LLM. A completion is the first `max_words` words
+    of the user text after its "Memoir text:" label (so answers echo the
+    retrieved context and keyword extraction echoes the question), and the
+    guard flags input containing any of `unsafe_terms`.
+    '''
+
+    DEFAULT_UNSAFE_TERMS = ('conceal', 'attack', 'replicate', 'weapon', 'avoid detection')
+
+    name = 'stub'
+
+    def __init__(self, latency=None, token_latency=None, max_words=40, unsafe_terms=None):
+        self.latency = latency or Latency('fixed', 0.0)
+        self.token_latency = token_latency or Latency('fixed', 0.0)
+        self.max_words = max_words
+        self.unsafe_terms = tuple(unsafe_terms or self.DEFAULT_UNSAFE_TERMS)
+
+    def _answer(self, user):
+        text = user.split('Memoir text:', 1)[-1]
+        return ' '.join(STUB_TOKEN_PATTERN.findall(text)[:self.max_words])
+
+    def complete(self, system, user, model, seed=None):
+        self.latency.sleep()
+        text = self._answer(user)
+        return Completion(text, (len(system) + len(user)) // 4 + 1, len(text) // 4 + 1)
+
+    def stream(self, system, user, model, seed=None):
+        self.latency.sleep()
+        text = self._answer(user)
+        for index, word in enumerate(text.split(' ')):
+            self.token_latency.sleep()
+            yield word if index == 0 else ' ' + word
+        return Completion(text, (len(system) + len(user)) // 4 + 1, len(text) // 4 + 1)
+
+    def moderate(self, user_input, model):
+        self.latency.sleep()
+        lowered = user_input.lower()
+        verdict = "unsafe\nS1" if any(term in lowered for term in self.unsafe_terms) else "safe"
+        return Completion(verdict, len(user_input) // 4 + 1, 2)
+
+def stub_png(key, size=64):
+    '''
+    A small solid-colour PNG whose colour is derived from key.
+    '''
+    red, green, blue = hashlib.sha256(key.encode('utf-8')).digest()[:3]
+    row = b'\x00' + bytes((red, green, blue)) * size
+    raw = zlib.compress(row * size)
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', raw) + chunk(b'IEND', b'')
+
+def _stub_image_handler():
+    '''
+    Request handler serving stub_png images for any path, after the server's
+    download latency. http.server is only imported when a stub server starts.
+    '''
+    import http.server
+
+    class StubImageHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.server.download_latency.sleep()
+            body = stub_png(self.path)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubImageHandler
+
+class StubImageBackend(ImageBackend):
+    '''
+    Deterministic offline text-to-image. Returned URLs point at a local
+    HTTP server (started on first use) that serves a PNG per prompt.
+    '''
+
+    name = 'stub'
+
+    def __init__(self, latency=None, download_latency=None, host='127.0.0.1', port=0):
+        self.latency = latency or Latency('fixed', 0.0)
+        self.download_latency = download_latency or Latency('fixed', 0.0)
+        self.host = host
+        self.port = port
+        self._server = None
+        self._lock = threading.Lock()
+
+    def _base_url(self):
+        with self._lock:
+            if self._server is None:
+                import http.server
+                self._server = http.server.ThreadingHTTPServer((self.host, self.port), _stub_image_handler())
+                self._server.daemon_threads = True
+                self._server.download_latency = self.download_latency
+                threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            host, port = self._server.server_address[:2]
+            return f'http://{host}:{port}'
+
+    def generate(self, model, input_data):
+        self.latency.sleep()
+        key = hashlib.sha256(repr(sorted(input_data.items())).encode('utf-8')).hexdigest()
+        return [f'{self._base_url()}/{key}.png'] * input_data.get('samples', 1)
+
+    def close(self):
+        '''
+        Stops the local image server.
+        '''
+        with self._lock:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+                self._server = None
+
+def _stub_groq_handler():
+    '''
+    Request handler answering Groq chat completion requests with the
+    server's stub LLM. http.server is only imported when a server starts.
+    '''
+    import http.server
+
+    class StubGroqHandler(http.server.BaseHTTPRequestHandler):
+        def _send_json(self, status, payload, headers=()):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not self.path.endswith('/chat/completions'):
+                self._send_json(404, {'error': {'message': 'not found'}})
+                return
+            if self.server.count_request():
+                retry_after = self.server.retry_after
+                self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'tokens'}}, [
+                    ('retry-after', str(retry_after)),
+                    ('x-ratelimit-remaining-requests', '0'),
+                    ('x-ratelimit-reset-requests', f'{retry_after}s'),
+                ])
+                return
+
+            llm = self.server.llm
+            model = request['model']
+            messages = {message['role']: message['content'] for message in request['messages']}
+            if 'guard' in model:
+                completion = llm.moderate(messages['user'], model)
+            else:
+                completion = llm.complete(messages.get('system'), messages['user'], model, request.get('seed'))
+            created = int(time.time())
+            if request.get('stream'):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                chunk = {'id': 'stub', 'object': 'chat.completion.chunk', 'created': created, 'model': model}
+                for index, word in enumerate(completion.text.split(' ')):
+                    delta = {'content': word if index == 0 else ' ' + word}
+                    chunk['choices'] = [{'index': 0, 'delta': delta, 'finish_reason': None}]
+                    self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+                # Like Groq, the last chunk carries the usage under x_groq
+                chunk['choices'] = [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]
+                chunk['x_groq'] = {'id': 'stub', 'usage': {
+                    'prompt_tokens': completion.prompt_tokens,
+                    'completion_tokens': completion.completion_tokens,
+                    'total_tokens': completion.prompt_tokens + completion.completion_tokens,
+                }}
+                self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+                self.wfile.write(b'data: [DONE]\n\n')
+                return
+            self._send_json(200, {
+                'id': 'stub', 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': completion.text},
+                             'finish_reason': 'stop'}],
+                'usage': {
+                    'prompt_tokens': completion.prompt_tokens,
+                    'completion_tokens': completion.completion_tokens,
+                    'total_tokens': completion.prompt_tokens + completion.completion_tokens,
+                },
+            })
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubGroqHandler
+
+class StubGroqServer:
+    '''
+    Local HTTP server speaking Groq's chat completions API, answered by a
+    StubLLMBackend. Every `rate_limit_every`-th request is rejected with a
+    429 and a Retry-After of `retry_after` seconds, to exercise the retry
+    path of GroqBackend and RateLimitedLLMBackend. `requests` counts the
+    requests received.
+    '''
+
+    def __init__(self, llm=None, rate_limit_every=0, retry_after=0.05, host='127.0.0.1', port=0):
+        import http.server
+        self._server = http.server.ThreadingHTTPServer((host, port), _stub_groq_handler())
+        self._server.daemon_threads = True
+        self._server.llm = llm or StubLLMBackend()
+        self._server.retry_after = retry_after
+        self._server.requests = 0
+        self._server.count_lock = threading.Lock()
+        self.rate_limit_every = rate_limit_every
+
+        def count_request():
+            with self._server.count_lock:
+                self._server.requests += 1
+                return bool(self.rate_limit_every) and self._server.requests % self.rate_limit_every == 0
+
+        self._server.count_request = count_request
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def requests(self):
+        return self._server.requests
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+def default_backends():
+    '''
+    Returns (llm_backend, image_backend) chosen by MEMOIR_BACKEND:
+    "stub" for the offline stubs, anything else for the rate-limited Groq
+    backend and Monster.
+    Stub latencies can be set with MEMOIR_STUB_LLM_LATENCY and
+    MEMOIR_STUB_IMAGE_LATENCY (see parse_latency).
+    '''
+    if os.environ.get('MEMOIR_BACKEND') == 'stub':
+        return (
+            StubLLMBackend(latency=parse_latency(os.environ.get('MEMOIR_STUB_LLM_LATENCY', 'fixed:0'))),
+            StubImageBackend(latency=parse_latency(os.environ.get('MEMOIR_STUB_IMAGE_LATENCY', 'fixed:0'))),
+        )
+    return RateLimitedLLMBackend(GroqBackend(max_retries=0)), MonsterBackend()
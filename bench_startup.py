@@ -0,0 +1,61 @@
+'''
+Startup benchmark for memoir_rag.
+
+Imports memoir_rag in fresh interpreters, reports the median import time,
+and fails if it exceeds the budget or if the import pulled in any of the
+heavy network/numeric packages that should only load on first use.
+
+    $ python3 bench_startup.py --budget-ms 150
+'''
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Packages that must not be imported by `import memoir_rag`
+DEFERRED_MODULES = ['groq', 'monsterapi', 'requests', 'httpx', 'numpy']
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import memoir_rag
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    'seconds': elapsed,
+    'loaded': [name for name in %r if name in sys.modules],
+}))
+''' % (DEFERRED_MODULES,)
+
+def measure_import(runs=5):
+    '''
+    Imports memoir_rag `runs` times, each in a new interpreter.
+    Returns (median seconds, modules from DEFERRED_MODULES that were loaded).
+    '''
+    timings = []
+    loaded = set()
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE], capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result['seconds'])
+        loaded.update(result['loaded'])
+    return statistics.median(timings), sorted(loaded)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="memoir_rag import-time benchmark")
+    parser.add_argument('--runs', type=int, default=5, help="Number of fresh interpreters to time")
+    parser.add_argument('--budget-ms', type=float, default=150.0, help="Maximum median import time in milliseconds")
+    args = parser.parse_args()
+
+    median, loaded = measure_import(args.runs)
+    print(f"import memoir_rag: {median * 1000:.1f} ms median over {args.runs} runs (budget {args.budget_ms:.0f} ms)")
+    if loaded:
+        print(f"FAIL: import loaded deferred modules: {', '.join(loaded)}")
+        sys.exit(1)
+    if median * 1000 > args.budget_ms:
+        print("FAIL: import time over budget")
+        sys.exit(1)
+    print("OK")
@@ -0,0 +1,213 @@
+'''
+Performance benchmarks for the memoir RAG pipeline.
+
+Builds synthetic memoirs at multiples of alan_test_doc.txt, then measures
+chapter splitting throughput, ingest rate, FTS query latency and end-to-end
+question latency with the offline stub backends (so only our own overhead
+and the simulated LLM latency are timed). Results are written as JSON so
+runs from different commits can be compared:
+
+    $ python3 benchmark.py --scales 10,100 --output bench_results.json
+'''
+
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import tempfile
+import time
+
+import memoir_rag
+from backends import StubImageBackend, StubLLMBackend, parse_latency
+from answer_cache import AnswerCache
+from llm_cache import LLMCache
+
+# Questions from test_questions.csv style used for query benchmarks
+BENCH_QUESTIONS = [
+    "what happened to alan in the water at Jones Beach?",
+    "What did the lifeguard do for Alan?",
+    "What jobs did Alan hold?",
+    "What clothing did Alan try to purchase in a deal?",
+    "Where was Alan heading, to meet his sister Rhonda?",
+    "Why did Alan get into a car crash?",
+    "What happened at the Grand Canyon?",
+    "How did the motorcycle crash in Denver happen?",
+]
+
+BENCH_KEYWORDS = [
+    "Jones Beach undertow",
+    "lifeguard whistle",
+    "jobs painter flea market",
+    "B.V.D. pocket t-shirts deal",
+    "Rhonda bar rock band",
+    "car crash drunk driver",
+    "Grand Canyon",
+    "motorcycle Denver",
+]
+
+def synthetic_memoir(source_text, scale, seed=0):
+    '''
+    Repeats the chapters of source_text `scale` times with fresh chapter
+    numbers, lightly shuffling sentences so copies are not identical.
+    '''
+    chapters = memoir_rag.chunk_by_chapter(source_text.lstrip('﻿'))
+    rng = random.Random(seed)
+    parts = []
+    number = 1
+    for copy in range(scale):
+        for chapter in chapters:
+            heading, _, body = chapter.partition('\n')
+            title = re.sub(r'^Chapter \d+ - ', '', heading).strip()
+            sentences = [text for text in re.split(r'(?<=[.!?])\s+', body) if text]
+            if copy:
+                rng.shuffle(sentences)
+            parts.append(f"Chapter {number} - {title}\n" + ' '.join(sentences))
+            number += 1
+    return '\n'.join(parts)
+
+def percentiles(samples):
+    '''
+    p50/p95/p99 and mean of samples, in milliseconds.
+    '''
+    if len(samples) < 2:
+        samples = samples * 2
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return {
+        'p50_ms': cuts[49] * 1000,
+        'p95_ms': cuts[94] * 1000,
+        'p99_ms': cuts[98] * 1000,
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'samples': len(samples),
+    }
+
+def bench_chunking(text, repeat=3):
+    '''
+    Best-of-`repeat` chunk_by_chapter throughput.
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chapters = memoir_rag.chunk_by_chapter(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    megabytes = len(text.encode('utf-8')) / 1e6
+    return {
+        'seconds': best,
+        'chapters': len(chapters),
+        'megabytes': megabytes,
+        'mb_per_sec': megabytes / best if best else None,
+        'chapters_per_sec': len(chapters) / best if best else None,
+    }
+
+def bench_ingest(conn, text, images=False):
+    '''
+    Times save_memoir_to_db and reports rows written per second.
+    '''
+    start = time.perf_counter()
+    memoir_id = memoir_rag.save_memoir_to_db(
+        conn, 'benchmark', 'alan plush', text,
+        progress=lambda *args: None, summaries=False, images=images,
+    )
+    elapsed = time.perf_counter() - start
+    rows = sum(
+        conn.execute(f'SELECT COUNT(*) FROM {table} WHERE memoir_id = ?', (memoir_id,)).fetchone()[0]
+        for table in ('memoir_chunks', 'memoir_chunks_fts', 'memoir_passages', 'memoir_passages_fts')
+    )
+    return memoir_id, {'seconds': elapsed, 'rows': rows, 'rows_per_sec': rows / elapsed}
+
+def bench_fts(conn, memoir_id, rounds=20):
+    '''
+    Latency of chapter and passage FTS queries over BENCH_KEYWORDS.
+    '''
+    results = {}
+    for name, search in (('chapters', memoir_rag.search_fts), ('passages', memoir_rag.search_passages)):
+        samples = []
+        for _ in range(rounds):
+            for keywords in BENCH_KEYWORDS:
+                start = time.perf_counter()
+                search(conn, keywords, memoir_id)
+                samples.append(time.perf_counter() - start)
+        results[name] = percentiles(samples)
+    return results
+
+def bench_end_to_end(conn, memoir_id, rounds=3, retrieval='keywords'):
+    '''
+    Latency of search_across_chunks with the stub LLM backend.
+    '''
+    samples = []
+    for _ in range(rounds):
+        for question in BENCH_QUESTIONS:
+            start = time.perf_counter()
+            memoir_rag.search_across_chunks(conn, question, memoir_id, 'alan plush', retrieval=retrieval)
+            samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(source_path, scales, llm_latency, rounds, images=False):
+    '''
+    Runs every benchmark at every scale and returns the results as a dict.
+    '''
+    # Stub providers, and no completion cache, so every call pays the simulated latency
+    memoir_rag.set_backends(
+        llm=StubLLMBackend(latency=parse_latency(llm_latency)),
+        image=StubImageBackend(),
+    )
+    memoir_rag.llm_cache = LLMCache(None, max_memory_entries=0)
+    memoir_rag.answer_cache = AnswerCache(None, max_entries=0)
+
+    with open(source_path, 'r', encoding='utf-8') as file:
+        source_text = file.read()
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'source': os.path.basename(source_path),
+        'llm_latency': llm_latency,
+        'scales': {},
+    }
+    for scale in scales:
+        text = synthetic_memoir(source_text, scale)
+        with tempfile.TemporaryDirectory() as directory:
+            conn = memoir_rag.initialize_db(os.path.join(directory, 'bench.db'))
+
+            result = {'chunking': bench_chunking(text)}
+            memoir_id, result['ingest'] = bench_ingest(conn, text, images=images)
+            result['fts'] = bench_fts(conn, memoir_id, rounds=rounds)
+            result['end_to_end'] = {
+                retrieval: bench_end_to_end(conn, memoir_id, rounds=max(1, rounds // 10), retrieval=retrieval)
+                for retrieval in ('keywords', 'llm', 'hybrid')
+            }
+            conn.close()
+        report['scales'][f'{scale}x'] = result
+        print(f"{scale}x: chunking {result['chunking']['mb_per_sec']:.1f} MB/s, "
+              f"ingest {result['ingest']['rows_per_sec']:.0f} rows/s, "
+              f"passage FTS p95 {result['fts']['passages']['p95_ms']:.2f} ms, "
+              f"end-to-end p95 {result['end_to_end']['keywords']['p95_ms']:.1f} ms")
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Memoir RAG benchmarks")
+    parser.add_argument('--source', default='alan_test_doc.txt', help="Memoir text the synthetic memoirs are built from")
+    parser.add_argument('--scales', default='10,100,1000', help="Comma-separated size multiples of the source memoir")
+    parser.add_argument('--llm-latency', default='lognormal:0.05,0.3', help="Stub LLM latency, e.g. fixed:0.2 or lognormal:0.4,0.5")
+    parser.add_argument('--rounds', type=int, default=20, help="Repetitions of the query set for FTS timings")
+    parser.add_argument('--images', action='store_true', help="Include the (stubbed) image stage in ingest timings")
+    parser.add_argument('--output', default='bench_results.json', help="Where to write the JSON results")
+    args = parser.parse_args()
+
+    scales = [int(scale) for scale in args.scales.split(',') if scale]
+    report = run_benchmarks(args.source, scales, args.llm_latency, args.rounds, images=args.images)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
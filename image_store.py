@@ -0,0 +1,157 @@
+'''
+Content-addressed store for generated chapter images.
+
+Images are named by a stable hash of the image backend, model and its
+generation parameters (prompt, seed, steps, ...), so the same prompt always
+maps to the same file and stub images are never served in place of real
+ones. The store is checked before the image backend is called, which
+makes regenerating an unchanged chapter free across runs and deduplicates
+identical prompts within one. Downloads go through one pooled HTTP session
+and are streamed to a temporary file that is renamed into place, so a
+failed download never leaves a truncated image behind. A small WebP
+thumbnail is written next to every image for the Streamlit app.
+
+requests and Pillow are imported on first use.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+# Longest side of the thumbnails shown in the app, in pixels
+THUMBNAIL_SIZE = 512
+THUMBNAIL_QUALITY = 80
+
+DEFAULT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gen_image')
+
+def image_key(model, input_data, backend=None):
+    '''
+    Stable hash of everything that determines a generated image, including
+    the name of the backend that generates it.
+    '''
+    payload = json.dumps([backend, model, input_data], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def thumbnail_path(image_path):
+    '''
+    Where the thumbnail of an image lives: thumbs/<name>.webp beside it.
+    '''
+    folder, name = os.path.split(image_path)
+    return os.path.join(folder, 'thumbs', os.path.splitext(name)[0] + '.webp')
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session(pool_size=8):
+    '''
+    Process-wide requests session whose connection pool is shared by every
+    download thread.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+def make_thumbnail(image_path, size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    '''
+    Writes the WebP thumbnail of image_path and returns its path, or None if
+    Pillow is not installed or the image can't be read.
+    '''
+    try:
+        from PIL import Image
+    except ImportError:
+        logging.warning("Pillow is not installed; skipping thumbnails")
+        return None
+    target = thumbnail_path(image_path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        with Image.open(image_path) as image:
+            image.thumbnail((size, size))
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGB')
+            _write_atomically(target, lambda file: image.save(file, 'WEBP', quality=quality))
+    except OSError as e:
+        logging.error(f"Error creating thumbnail for {image_path}: {e}")
+        return None
+    return target
+
+def _write_atomically(path, write):
+    '''
+    Calls write(file) on a temporary file in path's folder, then renames it
+    to path.
+    '''
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            write(file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+class ImageStore:
+    '''
+    Folder of images named <key>.png, with thumbnails in thumbs/.
+    Safe to share between threads; concurrent requests for the same key
+    wait for a single generation.
+    '''
+
+    def __init__(self, root=DEFAULT_ROOT, timeout=60, chunk_size=64 * 1024):
+        self.root = root
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.root, f'{key}.png')
+
+    def _key_lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, key):
+        '''
+        Path of the stored image for key, or None.
+        '''
+        path = self.path(key)
+        return path if os.path.exists(path) else None
+
+    def download(self, key, url):
+        '''
+        Streams url into the store under key and returns the image path.
+        '''
+        os.makedirs(self.root, exist_ok=True)
+        path = self.path(key)
+        with get_session().get(url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+
+            def write(file):
+                for block in response.iter_content(self.chunk_size):
+                    file.write(block)
+
+            _write_atomically(path, write)
+        return path
+
+    def get_or_create(self, key, generate):
+        '''
+        Returns the image path for key, calling generate() for an image URL
+        and downloading it only if the store doesn't have it yet. Missing
+        thumbnails are (re)created either way.
+        '''
+        with self._key_lock(key):
+            path = self.get(key)
+            if path is None:
+                path = self.download(key, generate())
+            if not os.path.exists(thumbnail_path(path)):
+                make_thumbnail(path)
+            return path
@@ -0,0 +1,159 @@
+'''
+Two-tier cache for LLM completions.
+
+Entries are keyed on a hash of (backend, model, system prompt, user text,
+seed), so the offline stubs never answer in place of Groq.
+Lookups go through an in-process LRU first and then an SQLite table stored
+next to memoirs.db, so deterministic completions survive restarts of the
+Streamlit app and repeated test runs. Both tiers honour a TTL and a maximum
+size, evicting the least recently used entries first.
+'''
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+def make_cache_key(model, system, user, seed, backend=None):
+    '''
+    Stable hash of everything that determines a completion, including the
+    name of the backend that produced it.
+    '''
+    payload = json.dumps([backend, model, system, user, seed], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class LLMCache:
+    '''
+    In-process LRU in front of an on-disk SQLite cache.
+    Safe to share between threads.
+    '''
+
+    def __init__(self, db_path='llm_cache.db', max_memory_entries=256,
+                 max_disk_entries=10000, ttl=7 * 24 * 3600):
+        self.db_path = db_path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.hits = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _disk(self):
+        '''
+        Opens the SQLite tier on first use so importing never touches disk.
+        '''
+        if self._conn is None and self.db_path:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT,
+                    created_at REAL,
+                    accessed_at REAL
+                )
+            ''')
+            self._conn.execute('''
+                CREATE INDEX IF NOT EXISTS llm_cache_accessed_at
+                ON llm_cache (accessed_at)
+            ''')
+            self._conn.commit()
+        return self._conn
+
+    def _expired(self, created_at, now):
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def get(self, key):
+        '''
+        Returns the cached completion for key, or None on a miss.
+        '''
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+
+            conn = self._disk()
+            if conn is not None:
+                row = conn.execute(
+                    'SELECT value, created_at FROM llm_cache WHERE key = ?', (key,)
+                ).fetchone()
+                if row and not self._expired(row[1], now):
+                    conn.execute('UPDATE llm_cache SET accessed_at = ? WHERE key = ?', (now, key))
+                    conn.commit()
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+                if row:
+                    conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                    conn.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        '''
+        Stores a completion in both tiers.
+        '''
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            conn = self._disk()
+            if conn is not None:
+                conn.execute('''
+                    INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at)
+                    VALUES (?, ?, ?, ?)
+                ''', (key, value, now, now))
+                conn.execute('''
+                    DELETE FROM llm_cache WHERE key IN (
+                        SELECT key FROM llm_cache
+                        ORDER BY accessed_at DESC
+                        LIMIT -1 OFFSET ?
+                    )
+                ''', (self.max_disk_entries,))
+                conn.commit()
+
+    def _remember(self, key, value, created_at):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        '''
+        Drops every entry from both tiers and resets the counters.
+        '''
+        with self._lock:
+            self._memory.clear()
+            conn = self._disk()
+            if conn is not None:
+                conn.execute('DELETE FROM llm_cache')
+                conn.commit()
+            self.hits = self.memory_hits = self.disk_hits = self.misses = 0
+
+    def stats(self):
+        '''
+        Hit/miss counters for monitoring.
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+            }
@@ -15,159 +15,385 @@ returning the best match from the memoir.
 '''
 
 import warnings
+import csv
+import functools
+import hashlib
+import json
+import random
 import logging
 import os
-import groq
 import sqlite3
 import argparse
 import re
-from monsterapi import client
-import requests
+import contextvars
+import threading
+import time
+from answer_cache import AnswerCache, memoir_fingerprint
+from backends import default_backends
+from image_store import ImageStore, image_key
+from llm_cache import LLMCache, make_cache_key
+from rate_limit import error_status, is_retryable, retry_after
+from storage import initialize_db, memoir_match
+from text import tokenize
+from tracing import annotate, iterate_in_context, record_usage, span, start_trace
+from vector_index import delete_embeddings, reciprocal_rank_fusion, search_vectors, update_embeddings
+from vocabulary import build_vocabulary, extract_local_keywords
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 ################################################################################
 # LLM setup
 ################################################################################
 
-groq_client = groq.Groq(
-    api_key=os.environ.get("GROQ_API_KEY"),
-)
+# Providers are reached through the backends module and built on first use,
+# so importing this module stays fast and read-only paths (browsing, FTS
+# queries) never load the network stack or need API keys.
+_backends = {}
+_backends_lock = threading.Lock()
 
-def run_llm(system, user, model='llama3-8b-8192', seed=None):
-    '''
-    Helper function to interact with the LLM using the Groq API.
-    '''
-    chat_completion = groq_client.chat.completions.create(
-        messages=[
-            {
-                'role': 'system',
-                'content': system,
-            },
-            {
-                "role": "user",
-                "content": user,
-            }
-        ],
-        model=model,
-        seed=seed,
-    )
-    return chat_completion.choices[0].message.content
+def set_backends(llm=None, image=None):
+    '''
+    Replaces the LLM and/or image backend, e.g. with the offline stubs.
+    '''
+    with _backends_lock:
+        if llm is not None:
+            _backends['llm'] = llm
+        if image is not None:
+            _backends['image'] = image
 
-################################################################################
-# Database functions
-################################################################################
+def _get_backend(kind):
+    with _backends_lock:
+        if kind not in _backends:
+            llm, image = default_backends()
+            _backends.setdefault('llm', llm)
+            _backends.setdefault('image', image)
+        return _backends[kind]
 
-def initialize_db(db_path='memoirs.db'):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+def get_llm_backend():
+    '''
+    Returns the LLM backend (Groq unless replaced or MEMOIR_BACKEND=stub).
+    '''
+    return _get_backend('llm')
 
-    # Create memoirs table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS memoirs (
-            id INTEGER PRIMARY KEY,
-            title TEXT,
-            author TEXT
-        )
-    ''')
+def get_image_backend():
+    '''
+    Returns the image backend (Monster unless replaced or MEMOIR_BACKEND=stub).
+    '''
+    return _get_backend('image')
 
-    # Create memoir chunks table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS memoir_chunks (
-            id INTEGER PRIMARY KEY,
-            memoir_id INTEGER,
-            content TEXT,
-            system_prompt TEXT,
-            FOREIGN KEY (memoir_id) REFERENCES memoirs (id)
-        )
-    ''')
+# Completions for deterministic calls (seeded, or temperature 0 like the guard)
+# are cached in memory and in an SQLite file next to memoirs.db.
+llm_cache = LLMCache(os.environ.get('LLM_CACHE_PATH', 'llm_cache.db'))
 
-    # Create an FTS table for fast full-text search
-    cursor.execute('''
-        CREATE VIRTUAL TABLE IF NOT EXISTS memoir_chunks_fts
-        USING fts5(content, chunk_id UNINDEXED, memoir_id UNINDEXED)
-    ''')
+# Answers already given, served to later questions that mean the same thing
+answer_cache = AnswerCache(os.environ.get('ANSWER_CACHE_PATH', 'answer_cache.db'))
 
-    conn.commit()
-    return conn
+def run_llm(system, user, model='llama3-8b-8192', seed=None, use_cache=True):
+    '''
+    Helper function to interact with the LLM backend (the Groq API by default).
+    Seeded calls are served from llm_cache when possible.
+    '''
+    cache_key = None
+    if use_cache and seed is not None:
+        cache_key = make_cache_key(model, system, user, seed, get_llm_backend().name)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            record_usage(cache_hit=True)
+            return cached
+
+    completion = get_llm_backend().complete(system, user, model, seed)
+    record_usage(completion.prompt_tokens, completion.completion_tokens)
+    content = completion.text
+    if cache_key:
+        llm_cache.set(cache_key, content)
+    return content
+
+def stream_llm(system, user, model='llama3-8b-8192', seed=None, use_cache=True):
+    '''
+    Streaming variant of run_llm: yields the completion as text deltas.
+    Cached completions are yielded in one piece, and a seeded completion
+    is cached once it has streamed in full. Token usage is recorded once
+    the stream ends.
+    '''
+    cache_key = None
+    if use_cache and seed is not None:
+        cache_key = make_cache_key(model, system, user, seed, get_llm_backend().name)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            record_usage(cache_hit=True)
+            yield cached
+            return
+
+    # The stream returns its Completion, with the usage from its last chunk
+    parts = []
+    completion = None
+    deltas = get_llm_backend().stream(system, user, model, seed)
+    try:
+        while True:
+            try:
+                delta = next(deltas)
+            except StopIteration as stop:
+                completion = stop.value
+                break
+            parts.append(delta)
+            yield delta
+    finally:
+        # Counted even if the caller stops reading early
+        if completion is None:
+            record_usage()
+        else:
+            record_usage(completion.prompt_tokens, completion.completion_tokens)
+    if cache_key:
+        llm_cache.set(cache_key, ''.join(parts))
+
+################################################################################
+# Database functions
+################################################################################
+
+def content_hash(text):
+    '''
+    Hash identifying a chapter's text.
+    '''
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
-def add_system_prompt_column(conn):
+def save_memoir_to_db(conn, title, author, content, **options):
     """
-    Ensures the system_prompt column exists in memoir_chunks.
+    Saves a memoir and its metadata to the database.
+    content is the full memoir text; see save_chapters_to_db for options.
     """
-    cursor = conn.cursor()
-    cursor.execute('''
-        PRAGMA table_info(memoir_chunks);
-    ''')
-    columns = [row[1] for row in cursor.fetchall()]
-    if 'system_prompt' not in columns:
-        cursor.execute('''
-            ALTER TABLE memoir_chunks ADD COLUMN system_prompt TEXT
-        ''')
-        conn.commit()
+    return save_chapters_to_db(conn, title, author, chunk_by_chapter(content), **options)
 
-def add_image_path_column(conn):
+def save_memoir_file(conn, title, author, file_path, **options):
     """
-    Adds column for generated image path in memoir_chunks.
+    Saves a memoir straight from a text file, reading it one chapter at a
+    time (see stream_chapters) so large manuscripts are never held in
+    memory whole. Options are passed to save_chapters_to_db.
     """
-    cursor = conn.cursor()
-    cursor.execute('''
-        PRAGMA table_info(memoir_chunks);
-    ''')
-    columns = [row[1] for row in cursor.fetchall()]
-    if 'image_path' not in columns:
-        cursor.execute('''
-            ALTER TABLE memoir_chunks ADD COLUMN image_path TEXT
-        ''')
-        conn.commit()
+    return save_chapters_to_db(
+        conn, title, author, (chapter.content for chapter in stream_chapters(file_path)), **options
+    )
 
-def save_memoir_to_db(conn, title, author, content):
+def save_chapters_to_db(conn, title, author, chapters, prompt_workers=4,
+                        image_workers=2, retries=2, progress=None, summaries=True,
+                        images=True, batch_size=32):
     """
-    Saves a memoir and its metadata to the database.
+    Saves a memoir given as an iterable of chapter texts.
+
+    Saving a memoir that already exists (same title and author) updates it
+    in place: chapters are compared by content hash, unchanged chapters are
+    kept with their prompts, summaries and images, edited chapters are
+    regenerated and removed chapters are deleted (see sync_chapters).
+    Text without any chapter heading raises ValueError and changes nothing.
+
+    Ingestion runs in stages: the memoir row, chunks and FTS rows are
+    committed in one batch, then system prompts, chapter summaries and
+    images are generated by bounded worker pools for the chapters that
+    lack them and written back as each stage finishes. summaries=False or
+    images=False skip those stages. Chapters are consumed one at a time and
+    each stage loads at most batch_size chapters at once.
     """
     cursor = conn.cursor()
-    
-    # Insert memoir metadata
-    cursor.execute('''
-        INSERT INTO memoirs (title, author)
-        VALUES (?, ?)
-    ''', (title, author))
-    memoir_id = cursor.lastrowid
-
-    # Chunk the memoir content by chapters
-    chapters = chunk_by_chapter(content)
-    for chapter in chapters:
+
+    # Stage 1: insert or update memoir metadata, chunks, passages and FTS rows in one transaction
+    memoir_id = find_memoir_id(conn, title, author)
+    if memoir_id is None:
         cursor.execute('''
-            INSERT INTO memoir_chunks (memoir_id, content)
+            INSERT INTO memoirs (title, author)
             VALUES (?, ?)
-        ''', (memoir_id, chapter))
-        chunk_id = cursor.lastrowid
+        ''', (title, author))
+        memoir_id = cursor.lastrowid
+    try:
+        changed = sync_chapters(conn, memoir_id, chapters)
+    except Exception:
+        conn.rollback()
+        raise
+    if changed:
+        build_vocabulary(conn, memoir_id)
+    conn.commit()
 
-        # Add to FTS table
-        cursor.execute('''
-            INSERT INTO memoir_chunks_fts (content, chunk_id, memoir_id)
-            VALUES (?, ?, ?)
-        ''', (chapter, chunk_id, memoir_id))
+    # Stage 2: generate a system prompt for every chapter that lacks one
+    fill_chunk_column(
+        conn, memoir_id, 'prompts', lambda chapter: generate_system_prompt(author, chapter),
+        'content', 'system_prompt', 'system_prompt IS NULL',
+        workers=prompt_workers, retries=retries, progress=progress, batch_size=batch_size,
+    )
+
+    # Stage 3: summarize new chapters, then the memoir as a whole, unless nothing changed
+    unsummarized = cursor.execute('''
+        SELECT
+            (SELECT summary IS NULL FROM memoirs WHERE id = ?)
+            OR EXISTS (SELECT 1 FROM memoir_chunks WHERE memoir_id = ? AND summary IS NULL)
+    ''', (memoir_id, memoir_id)).fetchone()[0]
+    if summaries and (changed or unsummarized):
+        summarize_memoir(
+            conn, memoir_id, author, workers=prompt_workers, retries=retries, progress=progress,
+            batch_size=batch_size,
+        )
 
-        # Generate a system prompt for the chapter
-        system_prompt = generate_system_prompt(author, chapter)
+    # Stage 4: generate an image for every chapter that has a prompt but no image
+    if images:
+        fill_chunk_column(
+            conn, memoir_id, 'images', _generate_image_or_raise,
+            'system_prompt', 'image_path', 'system_prompt IS NOT NULL AND image_path IS NULL',
+            workers=image_workers, retries=retries, progress=progress, batch_size=batch_size,
+        )
 
-        # Update the system_prompt column in memoir_chunks
-        cursor.execute('''
-            UPDATE memoir_chunks
-            SET system_prompt = ?
-            WHERE id = ?
-        ''', (system_prompt, chunk_id))
-
-        # Generate an image for the chapter
-        image_path = generate_image(system_prompt)
-        if image_path:
+    print(f"Memoir '{title}' by {author} saved with chunks, prompts, and images.")
+    return memoir_id
+
+def fill_chunk_column(conn, memoir_id, name, func, source, target, condition,
+                      workers=4, retries=2, progress=None, batch_size=32):
+    '''
+    Sets memoir_chunks.<target> to func(<source>) for the chunks of a memoir
+    matching condition, as run_stage `name`. Chunks are loaded and written
+    back batch_size at a time; chunks whose every attempt failed stay
+    unset for the next run.
+    '''
+    progress = progress or report_progress
+    total = conn.execute(
+        f'SELECT COUNT(*) FROM memoir_chunks WHERE memoir_id = ? AND {condition}', (memoir_id,)
+    ).fetchone()[0]
+    finished = 0
+    last_id = 0
+    while finished < total:
+        batch = conn.execute(f'''
+            SELECT id, {source} FROM memoir_chunks
+            WHERE memoir_id = ? AND {condition} AND id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (memoir_id, last_id, batch_size)).fetchall()
+        if not batch:
+            break
+        values = run_stage(
+            name,
+            func,
+            [value for _, value in batch],
+            workers=workers,
+            retries=retries,
+            progress=lambda stage, done, _: progress(stage, finished + done, total),
+        )
+        conn.executemany(
+            f'UPDATE memoir_chunks SET {target} = ? WHERE id = ?',
+            [(value, chunk_id) for value, (chunk_id, _) in zip(values, batch) if value]
+        )
+        conn.commit()
+        finished += len(batch)
+        last_id = batch[-1][0]
+
+def sync_chapters(conn, memoir_id, chapters):
+    '''
+    Makes the stored chunks of a memoir match `chapters`, position by
+    position, without committing. Chunks whose content hash is unchanged are
+    left alone. Other positions are rewritten in place, keeping chapter
+    order by id; their system prompt, summary and image are carried over
+    from any existing chunk with the same hash (a chapter that only moved)
+    and otherwise cleared so the later stages regenerate them, and their
+    FTS rows, passages and embeddings are rebuilt. Surplus chunks are
+    deleted along with their FTS rows, passages and embeddings, and
+    unchanged chunks that have no passages yet are indexed.
+    chapters may be any iterable; it is consumed one chapter at a time.
+    Raises ValueError, before deleting anything, if it holds no chapters.
+    Returns the number of chunks added, rewritten or deleted.
+    '''
+    cursor = conn.cursor()
+    # Chunks saved before hashes were stored are hashed now
+    for chunk_id, content in conn.execute('''
+        SELECT id, content FROM memoir_chunks WHERE memoir_id = ? AND content_hash IS NULL
+    ''', (memoir_id,)).fetchall():
+        cursor.execute(
+            'UPDATE memoir_chunks SET content_hash = ? WHERE id = ?', (content_hash(content), chunk_id)
+        )
+    stored = cursor.execute('''
+        SELECT id, content_hash, system_prompt, summary, image_path
+        FROM memoir_chunks WHERE memoir_id = ? ORDER BY id
+    ''', (memoir_id,)).fetchall()
+    generated = {row[1]: row[2:] for row in stored}
+    # Chapters saved before the passage index existed are indexed now
+    unindexed = [row[0] for row in conn.execute('''
+        SELECT id FROM memoir_chunks
+        WHERE memoir_id = ? AND trim(content) != ''
+          AND NOT EXISTS (SELECT 1 FROM memoir_passages WHERE chunk_id = memoir_chunks.id)
+    ''', (memoir_id,))]
+
+    touched = []
+    count = 0
+    for index, chapter in enumerate(chapters):
+        count += 1
+        chapter_hash = content_hash(chapter)
+        system_prompt, summary, image_path = generated.get(chapter_hash, (None, None, None))
+        if index < len(stored):
+            chunk_id, stored_hash = stored[index][:2]
+            if stored_hash == chapter_hash:
+                continue
             cursor.execute('''
                 UPDATE memoir_chunks
-                SET image_path = ?
+                SET content = ?, content_hash = ?, token_count = ?,
+                    system_prompt = ?, summary = ?, image_path = ?
                 WHERE id = ?
-            ''', (image_path, chunk_id))
+            ''', (chapter, chapter_hash, estimate_tokens(chapter),
+                  system_prompt, summary, image_path, chunk_id))
+            cursor.execute('DELETE FROM memoir_chunks_fts WHERE rowid = ?', (chunk_id,))
+        else:
+            cursor.execute('''
+                INSERT INTO memoir_chunks
+                    (memoir_id, content, content_hash, token_count, system_prompt, summary, image_path)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (memoir_id, chapter, chapter_hash, estimate_tokens(chapter),
+                  system_prompt, summary, image_path))
+            chunk_id = cursor.lastrowid
+        cursor.execute('''
+            INSERT INTO memoir_chunks_fts (rowid, content, chunk_id, memoir_id)
+            VALUES (?, ?, ?, ?)
+        ''', (chunk_id, chapter, chunk_id, memoir_id))
+        touched.append(chunk_id)
 
-    conn.commit()
-    print(f"Memoir '{title}' by {author} saved with chunks, prompts, and images.")
+    if not count:
+        # Never let a file without chapter headings wipe a saved memoir
+        raise ValueError("No chapters found; each chapter must start with a heading like 'Chapter 1 - Title'.")
+
+    removed = [row[0] for row in stored[count:]]
+    for chunk_id in removed:
+        cursor.execute('DELETE FROM memoir_chunks_fts WHERE rowid = ?', (chunk_id,))
+        cursor.execute('DELETE FROM memoir_chunks WHERE id = ?', (chunk_id,))
+
+    reindexed = list(dict.fromkeys(touched + removed + unindexed))
+    if reindexed:
+        index_passages(conn, memoir_id, chunk_ids=reindexed, commit=False)
+    return len(touched) + len(removed)
+
+def summarize_memoir(conn, memoir_id, author, workers=4, retries=2, progress=None, batch_size=32):
+    """
+    Generates summaries for chapters of a memoir that don't have one yet,
+    then regenerates the memoir-level summary from the chapter summaries.
+    """
+    cursor = conn.cursor()
+    fill_chunk_column(
+        conn, memoir_id, 'summaries', lambda chapter: generate_chapter_summary(author, chapter),
+        'content', 'summary', 'summary IS NULL',
+        workers=workers, retries=retries, progress=progress, batch_size=batch_size,
+    )
+
+    summaries = [row[0] for row in cursor.execute('''
+        SELECT summary FROM memoir_chunks
+        WHERE memoir_id = ? AND summary IS NOT NULL
+        ORDER BY id
+    ''', (memoir_id,))]
+    if summaries:
+        memoir_summary = run_stage(
+            'memoir summary',
+            lambda text: generate_memoir_summary(author, text),
+            ["\n\n".join(summaries)],
+            workers=1,
+            retries=retries,
+            progress=progress,
+        )[0]
+        if memoir_summary:
+            cursor.execute('''
+                UPDATE memoirs
+                SET summary = ?
+                WHERE id = ?
+            ''', (memoir_summary, memoir_id))
+            conn.commit()
 
 def load_memoir_from_db(conn, author):
     '''
@@ -180,6 +406,59 @@ def load_memoir_from_db(conn, author):
     result = cursor.fetchone()
     return result[0] if result else None
 
+def index_passages(conn, memoir_id, max_tokens=200, overlap=40, commit=True, chunk_ids=None):
+    '''
+    Rebuilds the passage index of a memoir from its stored chunks, or only
+    the passages of chunk_ids when given (ids of deleted chunks just have
+    their passages dropped). Only the passage tables and their embeddings
+    are touched, so a memoir can be re-chunked without regenerating system
+    prompts or images.
+    '''
+    cursor = conn.cursor()
+    if chunk_ids is None:
+        cursor.execute('''
+            DELETE FROM memoir_passages_fts
+            WHERE rowid IN (SELECT id FROM memoir_passages WHERE memoir_id = ?)
+        ''', (memoir_id,))
+        delete_embeddings(conn, 'SELECT id FROM memoir_passages WHERE memoir_id = ?', (memoir_id,))
+        cursor.execute('DELETE FROM memoir_passages WHERE memoir_id = ?', (memoir_id,))
+        # Read one chapter at a time rather than the whole memoir
+        chunks = conn.execute('''
+            SELECT id, content FROM memoir_chunks WHERE memoir_id = ? ORDER BY id
+        ''', (memoir_id,))
+    else:
+        def touched_chunks():
+            # Each chunk is read only when its turn comes, so a first save
+            # (where every chunk is touched) never holds the whole memoir
+            for chunk_id in chunk_ids:
+                cursor.execute('''
+                    DELETE FROM memoir_passages_fts
+                    WHERE rowid IN (SELECT id FROM memoir_passages WHERE chunk_id = ?)
+                ''', (chunk_id,))
+                delete_embeddings(conn, 'SELECT id FROM memoir_passages WHERE chunk_id = ?', (chunk_id,))
+                cursor.execute('DELETE FROM memoir_passages WHERE chunk_id = ?', (chunk_id,))
+                row = conn.execute('SELECT id, content FROM memoir_chunks WHERE id = ?', (chunk_id,)).fetchone()
+                if row is not None:
+                    yield row
+
+        chunks = touched_chunks()
+    count = 0
+    for chunk_id, content in chunks:
+        for start, end, passage in chunk_into_passages(content, max_tokens, overlap):
+            cursor.execute('''
+                INSERT INTO memoir_passages (memoir_id, chunk_id, start_char, end_char, content, token_count)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (memoir_id, chunk_id, start, end, passage, estimate_tokens(passage)))
+            cursor.execute('''
+                INSERT INTO memoir_passages_fts (rowid, content, passage_id, chunk_id, memoir_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (cursor.lastrowid, passage, cursor.lastrowid, chunk_id, memoir_id))
+            count += 1
+    update_embeddings(conn, memoir_id, commit=False)
+    if commit:
+        conn.commit()
+    return count
+
 ################################################################################
 # Memoir functions
 ################################################################################
@@ -192,22 +471,167 @@ def load_memoir(file_path):
         memoir_text = file.read()
     return memoir_text
 
-# Define a function to chunk the memoir by chapters
+# A chapter heading line: "Chapter 5 - Jones Beach Undertow", in any case,
+# with an Arabic or Roman number, a hyphen, en/em dash, colon or period
+# before the title (or no title), and stray surrounding whitespace
+CHAPTER_HEADING = re.compile(
+    r'^\s*chapter\s+(\d+|[ivxlcdm]+)\s*(?:(?:[-\u2013\u2014:.])\s*(.*?))?\s*$',
+    re.IGNORECASE,
+)
+
+UTF8_BOM = '\ufeff'
+
+# One chapter of a memoir file: its heading number and title, its text
+# (heading included), and the byte range it occupies in the file
+Chapter = namedtuple('Chapter', ['number', 'title', 'content', 'start', 'end'])
+
+def iter_chapters(lines):
+    '''
+    Groups (start, end, line) triples, where start and end are the line's
+    byte offsets, into Chapters as soon as each one ends. Lines keep their
+    trailing newline, except the one before the next heading. Text before
+    the first heading is skipped.
+    '''
+    heading = None
+    parts = []
+    start = end = 0
+    for offset, line_end, line in lines:
+        match = CHAPTER_HEADING.match(line)
+        if match:
+            if heading is not None:
+                yield Chapter(*heading, ''.join(parts).removesuffix('\n'), start, end)
+            heading = (match.group(1), match.group(2) or '')
+            parts = []
+            start = offset
+        if heading is not None:
+            parts.append(line)
+        end = line_end
+    if heading is not None:
+        yield Chapter(*heading, ''.join(parts), start, end)
+
+# A line break as universal newlines sees it: \r\n, a lone \r or \n
+BINARY_LINE_END = re.compile(rb'\r\n|\r|\n')
+
+def _normalize_line_end(line):
+    '''
+    line with its \r\n or \r ending replaced by \n.
+    '''
+    if line.endswith('\r\n'):
+        return line[:-2] + '\n'
+    if line.endswith('\r'):
+        return line[:-1] + '\n'
+    return line
+
+def _binary_lines(file, block_size=1 << 16):
+    '''
+    Yields (start, end, bytes) for every line of a binary file, read a
+    block at a time. Lines end at \r\n, a lone \r or \n, so a file with
+    old Mac line endings is not read as one huge line.
+    '''
+    offset = 0
+    buffer = b''
+    while True:
+        block = file.read(block_size)
+        buffer += block
+        start = 0
+        for match in BINARY_LINE_END.finditer(buffer):
+            if block and match.group() == b'\r' and match.end() == len(buffer):
+                # The \n of a \r\n may start the next block
+                break
+            yield offset, offset + match.end() - start, buffer[start:match.end()]
+            offset += match.end() - start
+            start = match.end()
+        buffer = buffer[start:]
+        if not block:
+            if buffer:
+                yield offset, offset + len(buffer), buffer
+            return
+
+def _decode_lines(binary_lines):
+    '''
+    Decodes (start, end, bytes) lines as UTF-8 with their endings turned
+    into \n, dropping a leading byte order mark.
+    '''
+    for offset, end, raw in binary_lines:
+        line = raw.decode('utf-8')
+        if offset == 0 and line.startswith(UTF8_BOM):
+            line = line[1:]
+            offset = len(UTF8_BOM.encode('utf-8'))
+        yield offset, end, _normalize_line_end(line)
+
+def stream_chapters(file_path):
+    '''
+    Yields the Chapters of a memoir file while reading it line by line, so
+    memory use is bounded by the longest chapter rather than the file.
+    Offsets are byte positions in the file.
+    '''
+    with open(file_path, 'rb') as file:
+        yield from iter_chapters(_decode_lines(_binary_lines(file)))
+
 def chunk_by_chapter(text):
     '''
     Splits the memoir into chapters based on the format "Chapter X - Title".
+    Line endings are normalized as in stream_chapters, so both give the
+    same chapters (and content hashes) for the same text.
     '''
-    # Regular expression to match chapter headings like "Chapter 5 - Jones Beach Undertow !!!"
-    chapter_pattern = r"(Chapter \d+ - .+?)(?=\nChapter \d+ - |\Z)"
-    
-    # Find all chapters based on the pattern
-    chapters = re.findall(chapter_pattern, text, re.DOTALL)
+    text = text.removeprefix(UTF8_BOM)
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    def lines():
+        offset = 0
+        *complete, last = text.split('\n')
+        for line in complete:
+            end = offset + len(line.encode('utf-8')) + 1
+            yield offset, end, line + '\n'
+            offset = end
+        if last:
+            yield offset, offset + len(last.encode('utf-8')), last
+    return [chapter.content for chapter in iter_chapters(lines())]
+
+# A sentence runs up to terminal punctuation (plus closing quotes) or a line break
+SENTENCE_PATTERN = re.compile(r'\S.*?(?:[.!?]+["\'\u201d\u2019)\]]*(?=\s)|(?=\r?\n)|$)', re.DOTALL)
+
+def split_sentences(text):
+    '''
+    Returns (start, end) character offsets of each sentence in text.
+    '''
+    return [match.span() for match in SENTENCE_PATTERN.finditer(text)]
+
+def chunk_into_passages(text, max_tokens=200, overlap=40):
+    '''
+    Splits a chapter into sentence-bounded passages of roughly max_tokens
+    words, where consecutive passages share about `overlap` words.
+    Returns a list of (start_char, end_char, passage_text).
+    '''
+    sentences = split_sentences(text)
+    lengths = [len(text[start:end].split()) for start, end in sentences]
+    passages = []
+    first = 0
+    while first < len(sentences):
+        last = first
+        tokens = lengths[first]
+        while last + 1 < len(sentences) and tokens + lengths[last + 1] <= max_tokens:
+            last += 1
+            tokens += lengths[last]
+
+        start, end = sentences[first][0], sentences[last][1]
+        passages.append((start, end, text[start:end]))
+        if last + 1 >= len(sentences):
+            break
 
-    return chapters
+        # Step back over trailing sentences to carry `overlap` words forward
+        next_first = last + 1
+        carried = 0
+        while next_first - 1 > first and carried + lengths[next_first - 1] <= overlap:
+            next_first -= 1
+            carried += lengths[next_first]
+        first = next_first
+    return passages
 
 def extract_keywords(text, seed=None):
     """
     Extracts search keywords from user input using the LLM.
+    See extract_local_keywords for the LLM-free extraction tried first.
     """
     system = (
         "You are a professional database query optimizer. "
@@ -215,95 +639,713 @@ def extract_keywords(text, seed=None):
         "that best represent the user's query. "
         "Return the keywords separated by spaces. Do not include any other text."
     )
-    keywords = run_llm(system, text, seed=seed).strip()
+    with span('keywords'):
+        keywords = run_llm(system, text, seed=seed).strip()
     return keywords
 
-def sanitize_for_match_query(keywords):
+# FTS query modes understood by sanitize_for_match_query
+FTS_QUERY_MODES = ('or', 'near', 'prefix', 'phrase')
+
+def sanitize_for_match_query(keywords, mode='or', near_distance=10):
     """
     Sanitizes extracted keywords for FTS MATCH queries.
+
+    keywords is a string of space-separated keywords, or a list of keywords
+    and phrases (e.g. from extract_local_keywords), each matched as a whole.
+    Each keyword becomes a quoted FTS5 string so reserved words like AND/NEAR
+    are treated as text, then the terms are combined according to mode:
+    'or' matches any term, 'near' requires the terms within near_distance
+    tokens of each other, 'prefix' ORs prefix matches, and 'phrase' matches
+    the keywords as one exact phrase.
     """
-    sanitized_keywords = re.sub(r'[^\w\s]', '', keywords)  # Remove non-alphanumeric chars
-    sanitized_keywords = ' '.join(sanitized_keywords.split())  # Normalize spaces
-    return f'"{sanitized_keywords}"' if sanitized_keywords else None
+    if mode not in FTS_QUERY_MODES:
+        raise ValueError(f"Unknown FTS query mode: {mode}")
+    if isinstance(keywords, str):
+        sanitized_keywords = re.sub(r'[^\w\s]', '', keywords)  # Remove non-alphanumeric chars
+        terms = sanitized_keywords.split()  # Normalize spaces
+    else:
+        terms = [' '.join(re.sub(r'[^\w\s]', '', term).split()) for term in keywords]
+        terms = [term for term in terms if term]
+    if not terms:
+        return None
 
-def search_across_chunks(conn, user_input, memoir_id, author, seed=None):
+    if mode == 'phrase':
+        return '"' + ' '.join(terms) + '"'
+    if mode == 'near':
+        if len(terms) == 1:
+            return f'"{terms[0]}"'
+        quoted = ' '.join(f'"{term}"' for term in terms)
+        return f'NEAR({quoted}, {near_distance})'
+    if mode == 'prefix':
+        return ' OR '.join(f'"{term}"*' for term in terms)
+    return ' OR '.join(f'"{term}"' for term in terms)
+
+def answer_system_prompt(author):
     """
-    Safety checks to classify user input before processing.
-    Extracts keywords and uses FTS match to return highest ranked chunk.
+    System prompt used for every memoir question.
     """
-    # Classify the user's input for safety using Llama Guard 3
-    is_safe, guard_response = classify_question_with_guard(user_input)
-    if not is_safe:
-        return f"Your question has been flagged as unsafe. Details: {guard_response}"
-    
-    # Step 1: Extract keywords
-    keywords = extract_keywords(user_input, seed=seed)
-    if not keywords:
-        return "I couldn't understand your query. Please try rephrasing."
+    return (
+        f"You are an assistant summarizing content from a memoir by {author}. "
+        "Answer the user's question based on the text provided. If you cannot find "
+        "specific information, respond with 'The memoir does not address this.'"
+    )
 
-    # Step 2: Sanitize for FTS MATCH
-    sanitized_keywords = sanitize_for_match_query(keywords)
-    if not sanitized_keywords:
-        return "No valid keywords found. Please refine your question."
+# A ranked FTS hit: snippet holds the best-matching span of content.
+# passage_id is only set for hits from the passage index.
+SearchResult = namedtuple(
+    'SearchResult', ['chunk_id', 'content', 'snippet', 'score', 'passage_id'], defaults=(None,)
+)
 
-    # Step 3: Perform FTS MATCH query
-    cursor = conn.cursor()
+# FTS table -> (bm25 weights, passage id column). bm25() takes one weight
+# per FTS column, in declaration order, and only content is searchable:
+# (content, chunk_id, memoir_id) for memoir_chunks_fts and
+# (content, passage_id, chunk_id, memoir_id) for memoir_passages_fts
+FTS_TABLES = {
+    'memoir_chunks_fts': ((1.0, 0.0, 0.0), 'NULL'),
+    'memoir_passages_fts': ((1.0, 0.0, 0.0, 0.0), 'passage_id'),
+}
+
+# One row of an FTS table matched by _rank_fts
+FtsHit = namedtuple('FtsHit', ['memoir_id', 'chunk_id', 'passage_id', 'content', 'snippet', 'score'])
+
+def _rank_fts(conn, searches, keywords, mode, k, snippet_tokens, scope):
+    """
+    Runs the MATCH query for keywords on each (FTS table, memoir_id) in
+    searches and returns (hits, message): the top k FtsHits across them,
+    best bm25 score first, or a message if the search could not run.
+    snippet_tokens is capped at 64, the FTS5 snippet() maximum.
+    """
+    match_query = sanitize_for_match_query(keywords, mode=mode)
+    if not match_query:
+        return None, "No valid keywords found. Please refine your question."
+
+    hits = []
     try:
-        cursor.execute('''
-            SELECT content
-            FROM memoir_chunks_fts
-            WHERE memoir_id = ? AND content MATCH ?
-            ORDER BY rank DESC
-        ''', (memoir_id, sanitized_keywords))
-        results = cursor.fetchall()
+        for table, memoir_id in searches:
+            weights, passage_column = FTS_TABLES[table]
+            hits += map(FtsHit._make, conn.execute(f'''
+                SELECT memoir_id, chunk_id, {passage_column}, content,
+                       snippet({table}, 0, '', '', '...', ?),
+                       bm25({table}, {', '.join('?' for _ in weights)}) AS score
+                FROM {table}
+                WHERE {table} MATCH ?
+                ORDER BY score
+                LIMIT ?
+            ''', (min(snippet_tokens, 64), *weights, memoir_match(match_query, memoir_id), k)))
     except sqlite3.OperationalError as e:
         logging.error(f"FTS MATCH query error: {e}")
-        return "An error occurred while searching the memoir."
+        return None, f"An error occurred while searching the {scope}."
+    return sorted(hits, key=lambda hit: hit.score)[:k], None
 
-    if not results:
-        # Fallback: Provide the entire memoir if no matches
-        cursor.execute('''
-            SELECT content
+def search_fts(conn, keywords, memoir_id, mode='or', k=3, snippet_tokens=64):
+    """
+    Runs the FTS MATCH query for the extracted keywords.
+    Returns (results, message) where results are the top k SearchResults,
+    best first, and message is set if the search could not run.
+    snippet_tokens is capped at 64, the FTS5 snippet() maximum.
+    """
+    hits, message = _rank_fts(
+        conn, [('memoir_chunks_fts', memoir_id)], keywords, mode, k, snippet_tokens, 'memoir'
+    )
+    if message:
+        return None, message
+    return [SearchResult(hit.chunk_id, hit.content, hit.snippet, hit.score) for hit in hits], None
+
+def search_passages(conn, keywords, memoir_id, mode='or', k=3, snippet_tokens=64):
+    """
+    Like search_fts, but over the passage index, so each result carries a
+    few hundred tokens instead of a whole chapter.
+    """
+    hits, message = _rank_fts(
+        conn, [('memoir_passages_fts', memoir_id)], keywords, mode, k, snippet_tokens, 'memoir'
+    )
+    if message:
+        return None, message
+    return [
+        SearchResult(hit.chunk_id, hit.content, hit.snippet, hit.score, hit.passage_id) for hit in hits
+    ], None
+
+def search_memoir(conn, keywords, memoir_id, mode='or', k=3, context_mode='passages'):
+    """
+    Searches a memoir for the best matches.
+    Passages are searched first; memoirs saved before the passage index
+    existed (or context_mode 'chunk') search whole chapters instead.
+    Returns (results, message) like search_fts.
+    """
+    if context_mode in ('passages', 'snippets'):
+        results, message = search_passages(conn, keywords, memoir_id, mode=mode, k=k)
+        if message or results:
+            return results, message
+    return search_fts(conn, keywords, memoir_id, mode=mode, k=k)
+
+def search_hybrid(conn, user_input, memoir_id, k=3):
+    """
+    Searches passages without an LLM round trip: a bm25 OR query over the
+    question's content words and a cosine search over passage embeddings
+    are fused with reciprocal rank fusion.
+    Returns (results, message) like search_fts.
+    """
+    lexical = []
+    terms = ' '.join(tokenize(user_input))
+    if terms:
+        lexical, message = search_passages(conn, terms, memoir_id, mode='or', k=k * 2)
+        if message:
+            return None, message
+    semantic = search_vectors(conn, user_input, memoir_id, k=k * 2)
+
+    fused = reciprocal_rank_fusion([
+        [result.passage_id for result in lexical],
+        [passage_id for passage_id, _, _ in semantic],
+    ])[:k]
+    if not fused:
+        return [], None
+
+    snippets = {result.passage_id: result.snippet for result in lexical}
+    placeholders = ','.join('?' for _ in fused)
+    rows = {row[0]: row for row in conn.execute(f'''
+        SELECT id, chunk_id, content FROM memoir_passages WHERE id IN ({placeholders})
+    ''', [passage_id for passage_id, _ in fused])}
+    return [
+        SearchResult(rows[passage_id][1], rows[passage_id][2],
+                     snippets.get(passage_id, rows[passage_id][2]), score, passage_id)
+        for passage_id, score in fused if passage_id in rows
+    ], None
+
+def load_full_memoir(conn, memoir_id):
+    """
+    Concatenates every chunk of a memoir.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT content
+        FROM memoir_chunks
+        WHERE memoir_id = ?
+    ''', (memoir_id,))
+    return " ".join(row[0] for row in cursor.fetchall())
+
+################################################################################
+# Memoir library
+################################################################################
+
+# One row of the memoir catalog
+Memoir = namedtuple('Memoir', ['id', 'title', 'author', 'chapters', 'summary'])
+
+# A passage found by search_library, with the memoir it belongs to
+LibraryResult = namedtuple(
+    'LibraryResult', ['memoir_id', 'title', 'author', 'chunk_id', 'passage_id', 'snippet', 'score']
+)
+
+def list_memoirs(conn):
+    '''
+    Every saved memoir with its chapter count, ordered by title and author.
+    '''
+    rows = conn.execute('''
+        SELECT memoirs.id, memoirs.title, memoirs.author,
+               (SELECT COUNT(*) FROM memoir_chunks WHERE memoir_chunks.memoir_id = memoirs.id),
+               memoirs.summary
+        FROM memoirs
+        ORDER BY memoirs.title, memoirs.author, memoirs.id
+    ''').fetchall()
+    return [Memoir(*row) for row in rows]
+
+def get_memoir(conn, memoir_id):
+    '''
+    Catalog entry of one memoir, or None.
+    '''
+    row = conn.execute('''
+        SELECT id, title, author,
+               (SELECT COUNT(*) FROM memoir_chunks WHERE memoir_id = memoirs.id),
+               summary
+        FROM memoirs WHERE id = ?
+    ''', (memoir_id,)).fetchone()
+    return Memoir(*row) if row else None
+
+def find_memoir_id(conn, title, author):
+    '''
+    Id of the saved memoir with this title and author, or None.
+    '''
+    row = conn.execute(
+        'SELECT id FROM memoirs WHERE title = ? AND author = ? ORDER BY id LIMIT 1',
+        (title, author)
+    ).fetchone()
+    return row[0] if row else None
+
+def search_library(conn, keywords, memoir_ids=None, mode='or', k=10, snippet_tokens=32):
+    """
+    Searches the passages of several memoirs at once (all of them when
+    memoir_ids is None) and returns (results, message) like search_fts,
+    with LibraryResults ranked together by bm25 across memoirs. Memoirs
+    saved before the passage index existed are searched by whole chapter
+    instead (their results have no passage_id), like search_memoir.
+    """
+    searches = []
+    if memoir_ids is None or memoir_ids:
+        searches.append(('memoir_passages_fts', memoir_ids))
+        unindexed = [row[0] for row in conn.execute('''
+            SELECT DISTINCT memoir_id FROM memoir_chunks
+            WHERE NOT EXISTS (
+                SELECT 1 FROM memoir_passages WHERE memoir_passages.memoir_id = memoir_chunks.memoir_id
+            )
+        ''') if memoir_ids is None or row[0] in memoir_ids]
+        if unindexed:
+            searches.append(('memoir_chunks_fts', unindexed))
+
+    hits, message = _rank_fts(conn, searches, keywords, mode, k, snippet_tokens, 'library')
+    if message:
+        return None, message
+    memoirs = {memoir_id: get_memoir(conn, memoir_id) for memoir_id in {hit.memoir_id for hit in hits}}
+    return [
+        LibraryResult(
+            hit.memoir_id, memoirs[hit.memoir_id].title, memoirs[hit.memoir_id].author,
+            hit.chunk_id, hit.passage_id, hit.snippet, hit.score,
+        )
+        for hit in hits
+    ], None
+
+################################################################################
+# Context assembly
+################################################################################
+
+# Hard context window of each model, in tokens
+MODEL_CONTEXT_TOKENS = {
+    'llama3-8b-8192': 8192,
+    'llama-guard-3-8b': 8192,
+}
+
+# Tokens kept free for the system prompt, the question and the answer
+RESERVED_TOKENS = 1536
+
+# Default number of memoir tokens sent with a question
+DEFAULT_CONTEXT_BUDGET = 1500
+
+def estimate_tokens(text):
+    """
+    Cheap token estimate, about four characters per token for English text.
+    """
+    return len(text) // 4 + 1
+
+def context_budget(model='llama3-8b-8192', budget=None):
+    """
+    Number of memoir tokens to send with a question to model.
+    Never exceeds the model's window minus RESERVED_TOKENS.
+    """
+    limit = MODEL_CONTEXT_TOKENS.get(model, 8192) - RESERVED_TOKENS
+    return min(budget or DEFAULT_CONTEXT_BUDGET, limit)
+
+def _rows_with_token_counts(conn, table, rows):
+    """
+    Fills in token_count for rows of (id, content, token_count) that were
+    stored before token counts were cached, saving the estimates when the
+    connection is writable.
+    """
+    missing = [(estimate_tokens(content), row_id) for row_id, content, tokens in rows if tokens is None]
+    if missing:
+        try:
+            conn.executemany(f'UPDATE {table} SET token_count = ? WHERE id = ?', missing)
+            conn.commit()
+        except sqlite3.OperationalError:
+            # Read-only connections (the Streamlit app) just use the estimates
+            pass
+        estimates = {row_id: tokens for tokens, row_id in missing}
+        rows = [(row_id, content, estimates.get(row_id, tokens)) for row_id, content, tokens in rows]
+    return rows
+
+def load_summaries(conn, memoir_id):
+    """
+    Returns (memoir_summary, [(chunk_id, heading, chapter_summary), ...]) for
+    a memoir, where heading is the chapter's first line ("Chapter 5 - Jones
+    Beach Undertow"). Memoirs that were never summarized give (None, []).
+    """
+    try:
+        row = conn.execute('SELECT summary FROM memoirs WHERE id = ?', (memoir_id,)).fetchone()
+        chapters = conn.execute('''
+            SELECT id, trim(substr(content, 1, instr(content || char(10), char(10)) - 1)), summary
             FROM memoir_chunks
-            WHERE memoir_id = ?
-        ''', (memoir_id,))
-        full_memoir = " ".join(row[0] for row in cursor.fetchall())
-        user_prompt = f"Memoir text: {full_memoir}\n\nUser's question: {user_input}"
-        system = (
-            f"You are an assistant summarizing content from a memoir by {author}. "
-            "Answer the user's question based on the text provided. If you cannot find "
-            "specific information, respond with 'The memoir does not address this.'"
+            WHERE memoir_id = ? AND summary IS NOT NULL
+            ORDER BY id
+        ''', (memoir_id,)).fetchall()
+    except sqlite3.OperationalError:
+        # Database predates the summary columns
+        return None, []
+    return (row[0] if row else None), chapters
+
+def _neighbour_passages(conn, results):
+    """
+    Passages directly before and after each passage hit, in the same chapter.
+    """
+    rows = []
+    for result in results:
+        if result.passage_id is None:
+            continue
+        rows += conn.execute('''
+            SELECT id, content, token_count FROM memoir_passages
+            WHERE chunk_id = ? AND id IN (?, ?)
+        ''', (result.chunk_id, result.passage_id - 1, result.passage_id + 1)).fetchall()
+    return _rows_with_token_counts(conn, 'memoir_passages', rows)
+
+def _nearby_chunks(conn, memoir_id, results, window=2, limit=16):
+    """
+    Chapters within `window` chapters of the ranked hits, nearest first,
+    or the first `limit` chapters in reading order when there are no hits.
+    Only those rows are read, so the cost does not grow with memoir length.
+    """
+    hit_chunk_ids = sorted({result.chunk_id for result in results})
+    if not hit_chunk_ids:
+        rows = conn.execute('''
+            SELECT id, content, token_count FROM memoir_chunks
+            WHERE memoir_id = ? ORDER BY id LIMIT ?
+        ''', (memoir_id, limit)).fetchall()
+        return _rows_with_token_counts(conn, 'memoir_chunks', rows)
+
+    # Chunks of a memoir are inserted together, so neighbouring chapters
+    # have neighbouring ids
+    rows = {}
+    for chunk_id in hit_chunk_ids:
+        for row in conn.execute('''
+            SELECT id, content, token_count FROM memoir_chunks
+            WHERE memoir_id = ? AND id BETWEEN ? AND ?
+        ''', (memoir_id, chunk_id - window, chunk_id + window)):
+            rows[row[0]] = row
+    rows = _rows_with_token_counts(conn, 'memoir_chunks', list(rows.values()))
+    return sorted(rows, key=lambda row: (min(abs(row[0] - chunk_id) for chunk_id in hit_chunk_ids), row[0]))
+
+def build_context(conn, memoir_id, results, model='llama3-8b-8192', budget=None,
+                  context_mode='passages'):
+    """
+    Assembles the memoir text sent with a question without exceeding the
+    token budget. Pieces are taken in priority order: the ranked search
+    results, then chapter summaries (hit chapters first), then passages next
+    to the hits, then whole chapters nearest to the hits (or in reading
+    order when nothing matched). Chapters that contain a hit are left out
+    to avoid repeating text. A piece that does not fit is skipped; if
+    nothing fits at all, the first piece is truncated.
+    """
+    remaining = context_budget(model, budget)
+    pieces = []
+    seen = set()
+    hit_chunks = {result.chunk_id for result in results}
+
+    def add(key, text, tokens):
+        nonlocal remaining
+        if key in seen or tokens > remaining:
+            return
+        seen.add(key)
+        pieces.append(text)
+        remaining -= tokens
+
+    for result in results:
+        text = result.snippet if context_mode == 'snippets' else result.content
+        key = ('passage', result.passage_id) if result.passage_id is not None else ('chunk', result.chunk_id)
+        add(key, text, estimate_tokens(text))
+
+    if context_mode != 'snippets':
+        # Chapter summaries are small and give the model the surrounding story
+        _, chapter_summaries = load_summaries(conn, memoir_id)
+        chapter_summaries.sort(key=lambda row: row[0] not in hit_chunks)
+        for chunk_id, heading, summary in chapter_summaries:
+            piece = f"{summary_label(heading)}: {summary}"
+            add(('summary', chunk_id), piece, estimate_tokens(piece))
+
+        for passage_id, content, tokens in _neighbour_passages(conn, results):
+            add(('passage', passage_id), content, tokens)
+        for chunk_id, content, tokens in _nearby_chunks(conn, memoir_id, results):
+            if chunk_id not in hit_chunks:
+                add(('chunk', chunk_id), content, tokens)
+
+    if not pieces and remaining > 0:
+        # Nothing fit whole: send as much of the best candidate as allowed
+        candidates = [result.content for result in results] or [
+            content for _, content, _ in _nearby_chunks(conn, memoir_id, results)
+        ]
+        if candidates:
+            pieces.append(candidates[0][:(remaining - 1) * 4])
+    return "\n\n".join(pieces)
+
+# Questions that explicitly ask about the memoir as a whole. Kept narrow:
+# a detail question sent to the summaries gets a summary-level answer.
+BROAD_QUESTION_PATTERN = re.compile(
+    r"\b(summar(?:y|ies|ize|ise)\w*|overview|overall|in general|"
+    r"(?:main|major|recurring) (?:themes?|events|ideas|points)|themes? of|"
+    r"(?:whole|entire) (?:life|memoir|book|story)|"
+    r"throughout (?:his|her|their|the) (?:life|memoir|book|story|career)|"
+    r"what is (?:the|this) (?:memoir|book|story) about)\b",
+    re.IGNORECASE,
+)
+
+# Reply the answer prompt asks for when the text lacks the answer
+NOT_ADDRESSED = "the memoir does not address this"
+
+def is_broad_question(user_input):
+    """
+    Heuristic for overview-style questions that summaries can answer.
+    """
+    return bool(BROAD_QUESTION_PATTERN.search(user_input))
+
+def summary_label(heading):
+    """
+    Label of a chapter summary, naming the chapter by its own heading so
+    "summarize chapter 5" finds Chapter 5 rather than the fifth chapter.
+    """
+    if CHAPTER_HEADING.match(heading):
+        return f"Summary of {heading}"
+    return "Chapter summary"
+
+def build_summary_context(conn, memoir_id, model='llama3-8b-8192', budget=None):
+    """
+    Memoir summary plus every chapter summary, within the token budget.
+    Returns None if the memoir has no summaries.
+    """
+    memoir_summary, chapter_summaries = load_summaries(conn, memoir_id)
+    if not memoir_summary and not chapter_summaries:
+        return None
+    remaining = context_budget(model, budget)
+    pieces = []
+    if memoir_summary:
+        pieces.append(f"Memoir summary: {memoir_summary}")
+        remaining -= estimate_tokens(pieces[-1])
+    for _, heading, summary in chapter_summaries:
+        piece = f"{summary_label(heading)}: {summary}"
+        tokens = estimate_tokens(piece)
+        if tokens > remaining:
+            break
+        pieces.append(piece)
+        remaining -= tokens
+    return "\n\n".join(pieces)
+
+# asyncio is imported inside the query functions below; it is one of the
+# slowest standard-library imports and browsing never needs it.
+
+# Shared pool for blocking LLM calls made from the async query path. Unlike the
+# loop's default executor it is not shut down by asyncio.run, so a flagged
+# question returns without waiting on a discarded keyword request.
+_query_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='memoir-query')
+
+def _run_in_thread(func, *args, **kwargs):
+    """
+    Schedules a blocking call on the query pool and returns an awaitable future.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    # Carry the current trace and span into the worker thread
+    context = contextvars.copy_context()
+    return loop.run_in_executor(_query_executor, functools.partial(context.run, func, *args, **kwargs))
+
+async def aprepare_answer(conn, user_input, memoir_id, author, seed=None,
+                          mode='or', k=3, context_mode='passages', context_tokens=None,
+                          retrieval='keywords', use_answer_cache=True, llm_keywords=True):
+    """
+    Runs every step of answering a question except the final completion.
+    Returns (answer, user_prompt, chunk_ids): answer is set when the
+    question was resolved early (flagged, unsearchable, answered from
+    summaries or from the answer cache), otherwise user_prompt holds the
+    prompt for the final completion and chunk_ids the chapters it draws on.
+
+    A question close enough to one already answered for this memoir (see
+    answer_cache) gets the stored answer once the guard has passed it,
+    without extracting keywords or calling the LLM again.
+
+    With retrieval='keywords' search terms come from the memoir's
+    vocabulary (see extract_local_keywords) while the guard call is in
+    flight. Only when none of the question's words occur in the memoir are
+    keywords requested from the LLM, unless llm_keywords is False.
+    retrieval='llm' always asks the LLM, and retrieval='hybrid' never does;
+    passages are then found by search_hybrid.
+
+    The safety check and LLM keyword extraction start at the same time, and
+    the FTS lookup runs as soon as keywords arrive. If the guard flags the
+    question, any work still in flight is cancelled and its result discarded.
+    The database connection is only used from the calling thread.
+    context_tokens caps the memoir text sent with the question (see build_context).
+    """
+    import asyncio
+    guard_task = _run_in_thread(classify_question_with_guard, user_input)
+    pending = {guard_task}
+    summary_task = None
+
+    cached = None
+    if use_answer_cache:
+        with span('answer_cache'):
+            cached = answer_cache.lookup(
+                memoir_id, memoir_fingerprint(conn, memoir_id), user_input, get_llm_backend().name
+            )
+    if cached is not None:
+        is_safe, guard_response = await guard_task
+        if not is_safe:
+            annotate(flagged=True)
+            return f"Your question has been flagged as unsafe. Details: {guard_response}", None, []
+        annotate(answer_cache_hit=True, matched_question=cached.question,
+                 similarity=cached.similarity, source_chunk_ids=cached.chunk_ids)
+        return cached.answer, None, cached.chunk_ids
+
+    # Overview questions are answered from the summaries first and only
+    # drill down into the memoir text if the summaries don't cover them.
+    # The summary answer is requested alongside the guard and retrieval.
+    if is_broad_question(user_input):
+        summary_context = build_summary_context(conn, memoir_id, budget=context_tokens)
+        if summary_context:
+            summary_task = _run_in_thread(
+                run_llm, answer_system_prompt(author),
+                f"Memoir text: {summary_context}\n\nUser's question: {user_input}", seed=seed
+            )
+
+    results = None
+    message = None
+    keywords_task = None
+    annotate(retrieval=retrieval)
+    if retrieval == 'hybrid':
+        with span('retrieval'):
+            results, message = search_hybrid(conn, user_input, memoir_id, k=k)
+    else:
+        keywords = None
+        if retrieval == 'keywords':
+            with span('local_keywords'):
+                keywords = extract_local_keywords(conn, memoir_id, user_input)
+            annotate(local_keywords=keywords)
+        if keywords:
+            with span('retrieval'):
+                results, message = search_memoir(
+                    conn, keywords, memoir_id, mode=mode, k=k, context_mode=context_mode
+                )
+        elif retrieval == 'llm' or llm_keywords:
+            keywords_task = _run_in_thread(extract_keywords, user_input, seed=seed)
+            pending.add(keywords_task)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            if guard_task in done:
+                is_safe, guard_response = guard_task.result()
+                if not is_safe:
+                    annotate(flagged=True)
+                    if summary_task is not None:
+                        summary_task.cancel()
+                    return f"Your question has been flagged as unsafe. Details: {guard_response}", None, []
+
+            if keywords_task in done:
+                keywords = keywords_task.result()
+                if not keywords:
+                    message = "I couldn't understand your query. Please try rephrasing."
+                else:
+                    with span('retrieval'):
+                        results, message = search_memoir(
+                            conn, keywords, memoir_id, mode=mode, k=k, context_mode=context_mode
+                        )
+    finally:
+        for task in pending:
+            task.cancel()
+
+    if summary_task is not None:
+        with span('summary_answer'):
+            answer = await summary_task
+        if NOT_ADDRESSED not in answer.lower():
+            annotate(answered_from_summaries=True)
+            if use_answer_cache:
+                remember_answer(conn, memoir_id, user_input, answer, [])
+            return answer, None, []
+
+    if message:
+        return message, None, []
+
+    # Fill the token budget from the ranked matches outward; with no matches
+    # this sends as much of the memoir as fits instead of the whole text
+    annotate(fallback_taken=not results)
+    with span('context') as record:
+        context = build_context(
+            conn, memoir_id, results or [], budget=context_tokens, context_mode=context_mode
         )
-        return run_llm(system, user_prompt, seed=seed)
+        if record is not None:
+            record['context_tokens'] = estimate_tokens(context)
 
-    # Step 4: Use the highest-ranked chunk for the LLM
-    best_match = results[0][0]
-    system = (
-        f"You are an assistant summarizing content from a memoir by {author}. "
-        "Answer the user's question based on the text provided. If you cannot find "
-        "specific information, respond with 'The memoir does not address this.'"
+    chunk_ids = list(dict.fromkeys(result.chunk_id for result in results or []))
+    return None, f"Memoir text: {context}\n\nUser's question: {user_input}", chunk_ids
+
+def remember_answer(conn, memoir_id, user_input, answer, chunk_ids):
+    '''
+    Stores a generated answer in the answer cache for similar questions.
+    '''
+    answer_cache.store(
+        memoir_id, memoir_fingerprint(conn, memoir_id), user_input, answer, chunk_ids,
+        get_llm_backend().name,
     )
-    user_prompt = f"Memoir text: {best_match}\n\nUser's question: {user_input}"
-    return run_llm(system, user_prompt, seed=seed)
+
+async def asearch_across_chunks(conn, user_input, memoir_id, author, seed=None, **options):
+    """
+    Async version of search_across_chunks.
+    Options (mode, k, context_mode, context_tokens, retrieval,
+    use_answer_cache, llm_keywords) are passed to aprepare_answer. New answers are
+    stored in the answer cache unless use_answer_cache is False.
+    """
+    with start_trace('question', question=user_input, memoir_id=memoir_id):
+        answer, user_prompt, chunk_ids = await aprepare_answer(
+            conn, user_input, memoir_id, author, seed=seed, **options
+        )
+        if answer is not None:
+            return answer
+        with span('answer'):
+            answer = await _run_in_thread(run_llm, answer_system_prompt(author), user_prompt, seed=seed)
+        if options.get('use_answer_cache', True):
+            remember_answer(conn, memoir_id, user_input, answer, chunk_ids)
+        return answer
+
+def search_across_chunks(conn, user_input, memoir_id, author, seed=None, **options):
+    """
+    Safety checks to classify user input before processing.
+    Extracts keywords and uses FTS match to return highest ranked chunk.
+    Thin synchronous wrapper around asearch_across_chunks.
+    """
+    import asyncio
+    return asyncio.run(asearch_across_chunks(
+        conn, user_input, memoir_id, author, seed=seed, **options
+    ))
+
+def stream_search_across_chunks(conn, user_input, memoir_id, author, seed=None, **options):
+    """
+    Streaming version of search_across_chunks: yields the answer as it is
+    generated. Answers resolved before the final completion (flagged
+    questions, summary answers) are yielded in one piece.
+    """
+    return iterate_in_context(
+        _stream_answer(conn, user_input, memoir_id, author, seed=seed, **options)
+    )
+
+def _stream_answer(conn, user_input, memoir_id, author, seed=None, **options):
+    """
+    Generator behind stream_search_across_chunks, traced as one question.
+    """
+    import asyncio
+    with start_trace('question', question=user_input, memoir_id=memoir_id, streamed=True):
+        answer, user_prompt, chunk_ids = asyncio.run(aprepare_answer(
+            conn, user_input, memoir_id, author, seed=seed, **options
+        ))
+        if answer is not None:
+            yield answer
+            return
+        parts = []
+        with span('answer') as record:
+            start = time.perf_counter()
+            for token in stream_llm(answer_system_prompt(author), user_prompt, seed=seed):
+                if record is not None and 'first_token_ms' not in record:
+                    record['first_token_ms'] = (time.perf_counter() - start) * 1000
+                parts.append(token)
+                yield token
+        if options.get('use_answer_cache', True):
+            remember_answer(conn, memoir_id, user_input, ''.join(parts), chunk_ids)
 
 def classify_question_with_guard(user_input):
     '''
     Classifies the user input for safety using Llama Guard 3.
+    The guard runs at temperature 0, so its verdicts are cached.
     '''
-    completion = groq_client.chat.completions.create(
-        model="llama-guard-3-8b",
-        messages=[
-            {
-                "role": "user",
-                "content": user_input,
-            }
-        ],
-        temperature=0,
-        max_tokens=1024,
-        top_p=1,
-        stop=None,
-    )
-    response = completion.choices[0].message.content
+    with span('guard'):
+        cache_key = make_cache_key("llama-guard-3-8b", None, user_input, 0, get_llm_backend().name)
+        response = llm_cache.get(cache_key)
+        if response is None:
+            completion = get_llm_backend().moderate(user_input, "llama-guard-3-8b")
+            record_usage(completion.prompt_tokens, completion.completion_tokens)
+            response = completion.text
+            llm_cache.set(cache_key, response)
+        else:
+            record_usage(cache_hit=True)
     if "unsafe" in response.lower():
         return False, response  # Unsafe detected, include category information
     return True, None  # Safe
@@ -337,11 +1379,35 @@ def generate_system_prompt(author, chapter_content):
     image_prompt = run_llm(system_prompt, chapter_content)
     return image_prompt 
 
-# Initialize the client with the API key from environment variables
-api_key = os.environ.get("MONSTER_API_KEY")
-monster_client = client(api_key)
+def generate_chapter_summary(author, chapter_content):
+    """
+    Generates a short summary of one chapter for overview questions.
+    """
+    system = (
+        f"You are summarizing a chapter of a memoir by {author}. "
+        "Write a summary of two to four sentences that names the key people, places, "
+        "events, jobs and objects in the chapter. Return only the summary."
+    )
+    return run_llm(system, chapter_content)
+
+def generate_memoir_summary(author, chapter_summaries):
+    """
+    Generates a short overview of the whole memoir from its chapter summaries.
+    """
+    system = (
+        f"You are summarizing a memoir by {author}. Based on the chapter summaries "
+        "below, write one paragraph describing the memoir as a whole. Return only the summary."
+    )
+    return run_llm(system, chapter_summaries)
+
+# Where generated images and their thumbnails are kept
+image_store = ImageStore()
 
 def generate_image(prompt):
+    """
+    Returns the path of the image for prompt, generating and downloading it
+    only if the content-addressed image store doesn't already have it.
+    """
     model = 'txt2img'
     input_data = {
         'prompt': prompt,
@@ -354,24 +1420,192 @@ def generate_image(prompt):
     }
 
     try:
-        result = monster_client.generate(model, input_data)
-        image_urls = result['output']
-
-        # Define the output folder relative to the current script location
-        output_folder = os.path.join(os.path.dirname(__file__), 'gen_image')
-        os.makedirs(output_folder, exist_ok=True)
-
-        image_path = os.path.join(output_folder, f'{hash(prompt)}.png')
-        image_data = requests.get(image_urls[0]).content
-        with open(image_path, 'wb') as image_file:
-            image_file.write(image_data)
-        
+        image_path = image_store.get_or_create(
+            image_key(model, input_data, get_image_backend().name),
+            lambda: get_image_backend().generate(model, input_data)[0],
+        )
         print(f"Image saved at {image_path}")
         return image_path
     except Exception as e:
         logging.error(f"Error generating image: {e}")
         return None
 
+def _generate_image_or_raise(prompt):
+    '''
+    Wraps generate_image so a failed generation can be retried by run_stage.
+    '''
+    image_path = generate_image(prompt)
+    if not image_path:
+        raise RuntimeError("image generation returned no path")
+    return image_path
+
+################################################################################
+# Ingestion pipeline
+################################################################################
+
+def report_progress(stage, done, total):
+    '''
+    Default progress reporter for ingestion stages.
+    '''
+    print(f"[{stage}] {done}/{total}")
+
+def run_stage(name, func, items, workers=4, retries=2, backoff=1.0, progress=None):
+    '''
+    Runs func over items on a bounded thread pool, retrying each item up to
+    `retries` extra times with exponential backoff. Returns results in input
+    order, with None for items that failed every attempt.
+    '''
+    progress = progress or report_progress
+    items = list(items)
+    results = [None] * len(items)
+    if not items:
+        return results
+
+    def attempt(item):
+        for attempt_number in range(retries + 1):
+            try:
+                return func(item)
+            except Exception as e:
+                logging.warning(f"{name} attempt {attempt_number + 1} failed: {e}")
+                if attempt_number < retries:
+                    time.sleep(backoff * 2 ** attempt_number)
+        return None
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(attempt, item): index for index, item in enumerate(items)}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            done += 1
+            progress(name, done, len(items))
+    return results
+
+################################################################################
+# Batch questions
+################################################################################
+
+def load_questions(path):
+    '''
+    Reads questions from a CSV file with a "question" column or a JSONL file
+    of objects with a "question" field. Every other column is kept and copied
+    into the results. Rows without an "id" are keyed by their question text.
+    '''
+    with open(path, 'r', encoding='utf-8', newline='') as file:
+        if path.endswith('.jsonl'):
+            rows = [json.loads(line) for line in file if line.strip()]
+        else:
+            rows = list(csv.DictReader(file))
+    for row in rows:
+        row.setdefault('id', row['question'])
+    return rows
+
+def load_finished_ids(output_path):
+    '''
+    Ids of questions already answered without error in an earlier run's
+    JSONL output, so an interrupted batch can pick up where it stopped.
+    '''
+    if not output_path or not os.path.exists(output_path):
+        return set()
+    finished = set()
+    with open(output_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write can leave a partial last line
+                continue
+            if record.get('error') is None:
+                finished.add(record['id'])
+    return finished
+
+def rate_limit_delay(error):
+    '''
+    Seconds to wait before retrying a rate-limited (HTTP 429) request,
+    taken from its rate-limit headers when present. None for other errors.
+    '''
+    if error_status(error) != 429:
+        return None
+    return retry_after(error) or 0.0
+
+async def arun_batch(conn, questions, memoir_id, author, output_path=None, concurrency=4,
+                     retries=3, backoff=1.0, seed=None, progress=None, **options):
+    """
+    Answers many questions concurrently. At most `concurrency` questions are
+    in flight; failed questions are retried with exponential backoff, and a
+    rate-limited request pauses every worker until its Retry-After has passed.
+    Rate limits and server errors are not retried here when the LLM backend
+    already retries them (see LLMBackend.retries_transient), so a question
+    gets the backend's retries rather than retries times as many.
+
+    Each result is appended to output_path (JSONL) as soon as it is ready.
+    Questions already answered in an existing output file are skipped, so
+    rerunning an interrupted batch resumes it. Returns the new results in
+    input order. Options are passed to asearch_across_chunks.
+    """
+    import asyncio
+    progress = progress or report_progress
+    finished = load_finished_ids(output_path)
+    todo = [question for question in questions if question['id'] not in finished]
+    results = [None] * len(todo)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    paused_until = 0.0
+    done = 0
+    output = open(output_path, 'a', encoding='utf-8') if output_path else None
+
+    async def answer(index, question):
+        nonlocal paused_until, done
+        record = dict(question)
+        async with semaphore:
+            start = time.perf_counter()
+            for attempt_number in range(retries + 1):
+                wait = paused_until - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    record['answer'] = await asearch_across_chunks(
+                        conn, question['question'], memoir_id, author, seed=seed, **options
+                    )
+                    record['error'] = None
+                    break
+                except Exception as e:
+                    record['answer'] = None
+                    record['error'] = repr(e)
+                    logging.warning(f"batch question {question['id']!r} attempt {attempt_number + 1} failed: {e}")
+                    if attempt_number == retries:
+                        break
+                    if is_retryable(e) and get_llm_backend().retries_transient:
+                        # The backend has already retried it; don't multiply its attempts
+                        break
+                    delay = backoff * 2 ** attempt_number * (1 + random.random())
+                    reset_delay = rate_limit_delay(e)
+                    if reset_delay is not None:
+                        delay = max(delay, reset_delay)
+                        paused_until = max(paused_until, time.monotonic() + delay)
+                    await asyncio.sleep(delay)
+            record['attempts'] = attempt_number + 1
+            record['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+        if output is not None:
+            output.write(json.dumps(record, ensure_ascii=False) + '\n')
+            output.flush()
+        results[index] = record
+        done += 1
+        progress('questions', done, len(todo))
+
+    try:
+        await asyncio.gather(*(answer(index, question) for index, question in enumerate(todo)))
+    finally:
+        if output is not None:
+            output.close()
+    return results
+
+def run_batch(conn, questions, memoir_id, author, **options):
+    """
+    Synchronous wrapper around arun_batch.
+    """
+    import asyncio
+    return asyncio.run(arun_batch(conn, questions, memoir_id, author, **options))
+
 # Suppress HTTPX logs
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
@@ -384,37 +1618,112 @@ if __name__ == '__main__':
     parser.add_argument('--title', type=str, help="Title of the memoir")
     parser.add_argument('--author', type=str, help="Author of the memoir")
     parser.add_argument('--content', type=str, help="Path to the text file of the memoir content (required for --save)")
+    parser.add_argument('--prompt-workers', type=int, default=4, help="Concurrent system prompt requests during --save")
+    parser.add_argument('--image-workers', type=int, default=2, help="Concurrent image generations during --save")
+    parser.add_argument('--retries', type=int, default=2, help="Retries per chapter for each ingestion stage")
+    parser.add_argument('--retrieval', choices=['keywords', 'llm', 'hybrid'], default='keywords', help="Find passages from keywords in the memoir's vocabulary (asking the LLM only if there are none), from LLM-extracted keywords, or with hybrid FTS + vector search")
+    parser.add_argument('--summarize', action='store_true', help="Generate missing chapter summaries and the memoir summary for a saved memoir")
+    parser.add_argument('--rechunk', action='store_true', help="Rebuild the passage index of a saved memoir without regenerating images")
+    parser.add_argument('--passage-tokens', type=int, default=200, help="Approximate words per passage for --rechunk")
+    parser.add_argument('--passage-overlap', type=int, default=40, help="Approximate words shared by consecutive passages for --rechunk")
+    parser.add_argument('--batch', type=str, help="Answer every question in a CSV or JSONL file instead of starting a Q&A session")
+    parser.add_argument('--output', type=str, default='answers.jsonl', help="JSONL file --batch appends answers to; rerunning resumes it")
+    parser.add_argument('--concurrency', type=int, default=4, help="Questions answered at once during --batch")
+    parser.add_argument('--list', action='store_true', help="List the memoirs in the library")
+    parser.add_argument('--memoir-id', type=int, help="Pick a saved memoir by its id (see --list) instead of --title and --author")
+    parser.add_argument('--search-library', type=str, metavar='KEYWORDS', help="Search the passages of every saved memoir")
     args = parser.parse_args()
     
     # Initialize the database connection
     conn = initialize_db()
-    add_system_prompt_column(conn)
-    add_image_path_column(conn)
 
-    if args.save:
+    if args.memoir_id:
+        memoir = get_memoir(conn, args.memoir_id)
+        if memoir:
+            args.title, args.author = memoir.title, memoir.author
+        else:
+            print(f"No memoir with id {args.memoir_id}; run --list to see the library.")
+
+    if args.list:
+        # Print the memoir catalog
+        for memoir in list_memoirs(conn):
+            print(f"{memoir.id}: '{memoir.title}' by {memoir.author} ({memoir.chapters} chapters)")
+
+    elif args.search_library:
+        # Rank matching passages across every memoir
+        results, message = search_library(conn, args.search_library)
+        if message:
+            print(message)
+        for result in results or []:
+            print(f"[{result.memoir_id}] '{result.title}' by {result.author}: {result.snippet}")
+
+    elif args.save:
         # Saving a memoir to the database
         if not (args.title and args.author and args.content):
             print("To save a memoir, please provide --title, --author, and --content.")
         else:
-            with open(args.content, 'r') as file:
-                content = file.read()
-            save_memoir_to_db(conn, args.title, args.author, content)
-            print(f"Memoir '{args.title}' by {args.author} has been saved to the database.")
+            try:
+                save_memoir_file(
+                    conn, args.title, args.author, args.content,
+                    prompt_workers=args.prompt_workers,
+                    image_workers=args.image_workers,
+                    retries=args.retries,
+                )
+                print(f"Memoir '{args.title}' by {args.author} has been saved to the database.")
+            except ValueError as e:
+                print(f"Memoir '{args.title}' by {args.author} was not saved: {e}")
     
+    elif args.summarize:
+        # Backfill summaries for a memoir saved before they existed
+        if not (args.title and args.author):
+            print("To summarize a memoir, please provide both --title and --author.")
+        else:
+            memoir_id = find_memoir_id(conn, args.title, args.author)
+            if memoir_id:
+                summarize_memoir(conn, memoir_id, args.author,
+                                 workers=args.prompt_workers, retries=args.retries)
+                print(f"Memoir '{args.title}' by {args.author} summarized.")
+            else:
+                print(f"Memoir '{args.title}' by {args.author} not found in the database.")
+
+    elif args.rechunk:
+        # Re-split stored chapters into passages
+        if not (args.title and args.author):
+            print("To rechunk a memoir, please provide both --title and --author.")
+        else:
+            memoir_id = find_memoir_id(conn, args.title, args.author)
+            if memoir_id:
+                count = index_passages(conn, memoir_id, args.passage_tokens, args.passage_overlap)
+                print(f"Memoir '{args.title}' by {args.author} re-indexed into {count} passages.")
+            else:
+                print(f"Memoir '{args.title}' by {args.author} not found in the database.")
+
+    elif args.batch:
+        # Answer a file of questions concurrently, streaming results to JSONL
+        if not (args.title and args.author):
+            print("To answer a batch of questions, please provide both --title and --author.")
+        else:
+            memoir_id = find_memoir_id(conn, args.title, args.author)
+            if memoir_id:
+                results = run_batch(
+                    conn, load_questions(args.batch), memoir_id, args.author,
+                    output_path=args.output, concurrency=args.concurrency,
+                    retries=args.retries, retrieval=args.retrieval,
+                )
+                failed = sum(1 for record in results if record['error'])
+                print(f"Answered {len(results) - failed} questions into {args.output} ({failed} failed).")
+            else:
+                print(f"Memoir '{args.title}' by {args.author} not found in the database.")
+
     else:
         # Load a memoir for Q&A session
         if not (args.title and args.author):
             print("To start a Q&A session, please provide both --title and --author.")
         else:
             # Check if the memoir exists in the database
-            cursor = conn.cursor()
-            memoir_id = cursor.execute(
-                'SELECT id FROM memoirs WHERE title = ? AND author = ?',
-                (args.title, args.author)
-            ).fetchone()
+            memoir_id = find_memoir_id(conn, args.title, args.author)
             
             if memoir_id:
-                memoir_id = memoir_id[0]
                 print(f"Memoir '{args.title}' by {args.author} loaded successfully.")
                 
                 # Start interactive Q&A session
@@ -424,9 +1733,14 @@ if __name__ == '__main__':
                         print("Exiting Q&A session.")
                         break
                     
-                    # Retrieve answer using search_across_chunks
-                    response = search_across_chunks(conn, user_input, memoir_id, args.author)
-                    print("\nResponse:\n", response)
+                    # Retrieve answer using stream_search_across_chunks
+                    # Print the answer as it streams in
+                    print("\nResponse:\n", end=' ', flush=True)
+                    for token in stream_search_across_chunks(
+                        conn, user_input, memoir_id, args.author, retrieval=args.retrieval
+                    ):
+                        print(token, end='', flush=True)
+                    print()
             else:
                 print(f"Memoir '{args.title}' by {args.author} not found in the database.")
 
@@ -0,0 +1,249 @@
+'''
+Client-side rate limiting, retries and request coalescing for the LLM
+provider.
+
+Groq limits every model by requests and tokens per minute. RateLimiter
+keeps a pair of token buckets per model and makes callers wait for
+capacity before a request is sent, instead of sending it and being
+rejected with HTTP 429. When the provider rejects one anyway, its
+Retry-After and x-ratelimit-reset-* headers pause every caller of that
+model until the limit resets, and other transient failures (5xx,
+timeouts, dropped connections) are retried with jittered exponential
+backoff. SingleFlight lets concurrent identical requests, e.g. several
+Streamlit sessions asking the same question, share one upstream call.
+
+Only the standard library is used, so importing this module is cheap.
+'''
+
+import random
+import re
+import threading
+import time
+
+# Groq limits (requests per minute, tokens per minute) of the models
+# memoir_rag uses; other models get DEFAULT_LIMIT
+MODEL_LIMITS = {
+    'llama3-8b-8192': (30, 30000),
+    'llama-guard-3-8b': (30, 15000),
+}
+DEFAULT_LIMIT = (30, 6000)
+
+# HTTP statuses worth retrying: timeout, conflict, rate limit and server errors
+RETRYABLE_STATUSES = (408, 409, 429)
+
+# Transport errors of the groq SDK, matched by name so groq isn't imported here
+RETRYABLE_ERRORS = ('APIConnectionError', 'APITimeoutError')
+
+class TokenBucket:
+    '''
+    Holds up to `capacity` units and refills `rate` units per second.
+    Reservations may overdraw the bucket; the caller then waits until the
+    deficit has refilled, so waiting callers are served in order.
+    Safe to share between threads.
+    '''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount=1):
+        '''
+        Takes amount units (at most a full bucket) and returns the seconds
+        to wait before using them.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= min(amount, self.capacity)
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.blocked_until - now)
+
+    def adjust(self, amount):
+        '''
+        Takes (or with a negative amount, returns) units without waiting,
+        e.g. to correct an estimate once the real usage is known.
+        '''
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+    def block(self, seconds):
+        '''
+        Makes every reservation wait at least `seconds` from now.
+        '''
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class RateLimiter:
+    '''
+    Requests-per-minute and tokens-per-minute buckets for each model.
+    limits maps a model to (requests per minute, tokens per minute).
+    '''
+
+    def __init__(self, limits=None, default=DEFAULT_LIMIT):
+        self.limits = dict(MODEL_LIMITS if limits is None else limits)
+        self.default = default
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.waited = 0.0
+
+    def buckets(self, model):
+        '''
+        The (requests, tokens) buckets of a model, created on first use.
+        '''
+        with self._lock:
+            if model not in self._buckets:
+                requests, tokens = self.limits.get(model, self.default)
+                self._buckets[model] = (
+                    TokenBucket(requests / 60.0, requests),
+                    TokenBucket(tokens / 60.0, tokens),
+                )
+            return self._buckets[model]
+
+    def acquire(self, model, tokens):
+        '''
+        Waits until one request of about `tokens` tokens may be sent.
+        Returns the seconds waited.
+        '''
+        requests_bucket, tokens_bucket = self.buckets(model)
+        wait = max(requests_bucket.reserve(1), tokens_bucket.reserve(tokens))
+        if wait > 0:
+            with self._lock:
+                self.waited += wait
+            time.sleep(wait)
+        return wait
+
+    def record(self, model, estimated, actual):
+        '''
+        Corrects the token bucket once a response reports its real usage.
+        '''
+        if actual is not None:
+            self.buckets(model)[1].adjust(actual - estimated)
+
+    def pause(self, model, seconds):
+        '''
+        Holds back every request to a model, e.g. until a 429 resets.
+        '''
+        for bucket in self.buckets(model):
+            bucket.block(seconds)
+
+################################################################################
+# Errors and backoff
+################################################################################
+
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+
+def parse_duration(value):
+    '''
+    Seconds in a rate-limit header: "7.66s", "2m59.56s", "120ms" or a plain
+    number of seconds. None if it can't be read.
+    '''
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts or ''.join(number + unit for number, unit in parts) != value:
+        return None
+    scale = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+def error_status(error):
+    '''
+    HTTP status of a provider error, or None for transport errors.
+    '''
+    response = getattr(error, 'response', None)
+    return getattr(error, 'status_code', None) or getattr(response, 'status_code', None)
+
+def retry_after(error):
+    '''
+    Seconds the provider asked us to wait before retrying: its Retry-After
+    header, or else the reset time of whichever x-ratelimit limit ran out.
+    None if the error carries no such hint.
+    '''
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    delay = parse_duration(headers.get('retry-after'))
+    if delay is not None:
+        return delay
+    resets = [
+        parse_duration(headers.get(f'x-ratelimit-reset-{limit}'))
+        for limit in ('requests', 'tokens')
+        if headers.get(f'x-ratelimit-remaining-{limit}') == '0'
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+def is_retryable(error):
+    '''
+    Whether a failed request may succeed if sent again.
+    '''
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES or status >= 500
+    return isinstance(error, (ConnectionError, TimeoutError)) or type(error).__name__ in RETRYABLE_ERRORS
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    '''
+    "Full jitter" exponential backoff: a random delay of up to
+    base * 2**attempt seconds, capped at `cap`.
+    '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+################################################################################
+# Request coalescing
+################################################################################
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    '''
+    Runs at most one call per key at a time. Callers that arrive while a
+    call with their key is in flight wait for it and get its result (or
+    its exception) instead of making their own. Safe to share between
+    threads.
+    '''
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+
+    def do(self, key, func):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.shared += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
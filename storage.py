@@ -0,0 +1,226 @@
+'''
+SQLite storage for memoirs: connections, pragmas and schema migrations.
+
+Every connection is opened through connect(), which turns on WAL so the
+Streamlit app can keep reading while an ingest writes, and tunes the
+pragmas for this read-heavy workload. The schema is versioned with
+PRAGMA user_version: migrate() applies the steps in MIGRATIONS that a
+database has not seen yet, each in its own transaction, so databases
+created by any earlier version of memoir_rag are brought up to date in
+place.
+
+The FTS tables index memoir_id as a column and their rowids are the ids of
+the chunks and passages they cover. memoir_match() restricts a MATCH query
+to one memoir inside the full-text index instead of filtering every match
+afterwards, and rows are updated and deleted by rowid.
+'''
+
+import sqlite3
+
+from vector_index import add_embedding_table, update_embeddings
+from vocabulary import add_vocabulary_table, build_vocabulary
+
+# Applied to every connection
+PRAGMAS = (
+    ('busy_timeout', 5000),       # wait for a concurrent writer instead of failing
+    ('synchronous', 'NORMAL'),    # durable enough with WAL, and much faster
+    ('temp_store', 'MEMORY'),
+    ('cache_size', -16000),       # 16 MB page cache
+    ('mmap_size', 64 * 1024 * 1024),
+)
+
+# Parsed statements kept per connection; retrieval reuses a handful of
+# queries, so none of them is parsed twice
+CACHED_STATEMENTS = 256
+
+def connect(db_path='memoirs.db', readonly=False, check_same_thread=True):
+    '''
+    Opens the database with WAL and the tuned pragmas. readonly=True opens
+    it read-only (for the app), which still sees every commit made by a
+    writer in another process.
+    '''
+    if readonly:
+        conn = sqlite3.connect(
+            f'file:{db_path}?mode=ro', uri=True,
+            check_same_thread=check_same_thread, cached_statements=CACHED_STATEMENTS,
+        )
+    else:
+        conn = sqlite3.connect(
+            db_path, check_same_thread=check_same_thread, cached_statements=CACHED_STATEMENTS,
+        )
+        conn.execute('PRAGMA journal_mode = WAL')
+    for name, value in PRAGMAS:
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn):
+    '''
+    Applies pending migrations in order and returns the schema version.
+    Each runs in an immediate transaction and re-checks the version first,
+    so two processes starting at once don't apply a step twice.
+    '''
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if schema_version(conn) >= version:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if schema_version(conn) < version:
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return schema_version(conn)
+
+def initialize_db(db_path='memoirs.db'):
+    '''
+    Opens the database read-write and brings its schema up to date.
+    '''
+    conn = connect(db_path)
+    migrate(conn)
+    return conn
+
+def memoir_match(match_query, memoir_id):
+    '''
+    FTS MATCH expression for match_query over content, limited to one
+    memoir or to any of a list of memoirs. memoir_id=None searches them all.
+    '''
+    if memoir_id is None:
+        return f'content : ({match_query})'
+    if isinstance(memoir_id, int):
+        return f'memoir_id : {memoir_id} AND content : ({match_query})'
+    memoir_ids = ' OR '.join(str(int(value)) for value in memoir_id)
+    return f'memoir_id : ({memoir_ids}) AND content : ({match_query})'
+
+################################################################################
+# Migrations
+################################################################################
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table});')]
+
+def _add_column(conn, table, column, column_type):
+    if column not in _columns(conn, table):
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+def _base_tables(conn):
+    '''
+    Version 1: memoirs, chapter chunks, passages and embeddings, with every
+    column earlier versions added one at a time. Databases from before
+    versioning already have some of them.
+    '''
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS memoirs (
+            id INTEGER PRIMARY KEY,
+            title TEXT,
+            author TEXT
+        )
+    ''')
+    _add_column(conn, 'memoirs', 'summary', 'TEXT')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS memoir_chunks (
+            id INTEGER PRIMARY KEY,
+            memoir_id INTEGER,
+            content TEXT,
+            system_prompt TEXT,
+            FOREIGN KEY (memoir_id) REFERENCES memoirs (id)
+        )
+    ''')
+    for column, column_type in (('system_prompt', 'TEXT'), ('image_path', 'TEXT'),
+                                ('token_count', 'INTEGER'), ('summary', 'TEXT'),
+                                ('content_hash', 'TEXT')):
+        _add_column(conn, 'memoir_chunks', column, column_type)
+
+    # Overlapping sub-chapter spans of each chunk
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS memoir_passages (
+            id INTEGER PRIMARY KEY,
+            memoir_id INTEGER,
+            chunk_id INTEGER,
+            start_char INTEGER,
+            end_char INTEGER,
+            content TEXT,
+            token_count INTEGER,
+            FOREIGN KEY (memoir_id) REFERENCES memoirs (id),
+            FOREIGN KEY (chunk_id) REFERENCES memoir_chunks (id)
+        )
+    ''')
+    _add_column(conn, 'memoir_passages', 'token_count', 'INTEGER')
+
+    add_embedding_table(conn)
+
+def _foreign_key_indexes(conn):
+    '''
+    Version 2: indexes for looking up chunks and passages by memoir and
+    chapter, and memoirs by title and author.
+    '''
+    conn.execute('CREATE INDEX IF NOT EXISTS memoir_chunks_memoir ON memoir_chunks (memoir_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS memoir_passages_memoir ON memoir_passages (memoir_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS memoir_passages_chunk ON memoir_passages (chunk_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS memoirs_title_author ON memoirs (title, author)')
+
+def _rebuild_fts(conn, table, columns, source):
+    '''
+    Recreates an FTS table with memoir_id indexed, rowids taken from
+    `source` and a prefix index, copying rows from the old table if any.
+    '''
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    conn.execute(f'DROP TABLE IF EXISTS {table}_new')
+    spec = ', '.join(
+        column if column in ('content', 'memoir_id') else f'{column} UNINDEXED' for column in columns
+    )
+    conn.execute(f"CREATE VIRTUAL TABLE {table}_new USING fts5({spec}, prefix='2 3')")
+    if exists:
+        column_list = ', '.join(columns)
+        conn.execute(f'''
+            INSERT INTO {table}_new (rowid, {column_list})
+            SELECT {source}, {column_list} FROM {table}
+        ''')
+        conn.execute(f'DROP TABLE {table}')
+    conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+def _memoir_scoped_fts(conn):
+    '''
+    Version 3: FTS tables keyed by chunk or passage id with memoir_id
+    indexed, so searches and deletes touch only one memoir's rows.
+    '''
+    _rebuild_fts(conn, 'memoir_chunks_fts', ('content', 'chunk_id', 'memoir_id'), 'chunk_id')
+    _rebuild_fts(
+        conn, 'memoir_passages_fts', ('content', 'passage_id', 'chunk_id', 'memoir_id'), 'passage_id'
+    )
+
+def _vocabulary(conn):
+    '''
+    Version 4: the per-memoir vocabulary used for local keyword
+    extraction, built for every memoir already saved.
+    '''
+    add_vocabulary_table(conn)
+    for (memoir_id,) in conn.execute('SELECT id FROM memoirs').fetchall():
+        build_vocabulary(conn, memoir_id)
+
+def _embedding_ids(conn):
+    '''
+    Version 5: embeddings get ids of their own. Earlier versions kept the
+    vector of a deleted passage when its id was reused, so every memoir is
+    embedded again.
+    '''
+    if 'id' not in _columns(conn, 'memoir_embeddings'):
+        conn.execute('DROP TABLE memoir_embeddings')
+        add_embedding_table(conn)
+        for (memoir_id,) in conn.execute('SELECT id FROM memoirs').fetchall():
+            update_embeddings(conn, memoir_id, commit=False)
+
+MIGRATIONS = (
+    _base_tables,
+    _foreign_key_indexes,
+    _memoir_scoped_fts,
+    _vocabulary,
+    _embedding_ids,
+)
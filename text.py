@@ -0,0 +1,55 @@
+'''
+Word-level text helpers shared by retrieval, the vocabulary and the
+answer cache: the stopword list, a tokenizer and a crude stemmer.
+'''
+
+import re
+
+# Words that carry no retrieval signal in questions about the memoir
+STOPWORDS = frozenset('''
+    a about above after again against all am an and any are as at be because been
+    before being below between both but by can could did do does doing down during
+    each few for from further had has have having he her here hers herself him
+    himself his how i if in into is it its itself just me more most my myself no
+    nor not now of off on once only or other our ours ourselves out over own same
+    she should so some such than that the their theirs them themselves then there
+    these they this those through to too under until up very was we were what when
+    where which while who whom why will with would you your yours yourself
+    yourselves tell describe explain happened happen
+'''.split())
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+# Suffixes removed by stem, longest first
+SUFFIXES = ('ingly', 'edly', 'ing', 'ies', 'ied', 'es', 'ed', 'ly', 's')
+
+def tokenize(text, drop_stopwords=True):
+    '''
+    Lowercased word tokens, optionally without stopwords.
+    '''
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    if drop_stopwords:
+        tokens = [token for token in tokens if token not in STOPWORDS]
+    return tokens
+
+def stem(word):
+    '''
+    Crude suffix-stripping stemmer: enough to fold plurals, tenses and -ly
+    adverbs onto one form ("helped", "helps", "helping" -> "help").
+    '''
+    for suffix in SUFFIXES:
+        if suffix == 's' and word.endswith('ss'):
+            break
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            if suffix in ('ies', 'ied'):
+                return word[:-3] + 'y'
+            if suffix == 'es' and not word[:-2].endswith(('s', 'x', 'z', 'ch', 'sh')):
+                # "waves" -> "wave", but "beaches" -> "beach"
+                word = word[:-1]
+            else:
+                word = word[:-len(suffix)]
+            break
+    # Fold a silent final e so "wave" and "waved" agree
+    if len(word) >= 4 and word.endswith('e'):
+        word = word[:-1]
+    return word
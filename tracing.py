@@ -0,0 +1,237 @@
+'''
+Lightweight tracing for the question pipeline.
+
+A trace covers one question; spans time each stage inside it (guard,
+keywords, retrieval, context assembly, answer) and carry attributes such as
+token usage, cache hits and whether the fallback path was taken. Finished
+traces are handed to pluggable sinks: an in-memory ring buffer (always
+installed, read by the Streamlit debug panel), the logging module, or a
+JSONL file.
+
+Set MEMOIR_TRACE=log to log every trace, and MEMOIR_TRACE_FILE=path to
+append traces to a JSONL file.
+'''
+
+import contextlib
+import contextvars
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+_current_trace = contextvars.ContextVar('memoir_trace', default=None)
+_current_span = contextvars.ContextVar('memoir_span', default=None)
+_trace_ids = itertools.count(1)
+
+class Trace:
+    '''
+    Timings and attributes collected while answering one question.
+    '''
+
+    def __init__(self, name, **attributes):
+        self.trace_id = next(_trace_ids)
+        self.name = name
+        self.attributes = attributes
+        self.spans = []
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms = None
+        self._lock = threading.Lock()
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self._start) * 1000
+
+    def add_span(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def stage_durations(self):
+        '''
+        Total milliseconds per span name.
+        '''
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                totals[span['name']] = totals.get(span['name'], 0.0) + span['duration_ms']
+        return totals
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'trace_id': self.trace_id,
+                'name': self.name,
+                'started_at': self.started_at,
+                'duration_ms': self.duration_ms,
+                **self.attributes,
+                'spans': list(self.spans),
+            }
+
+################################################################################
+# Sinks
+################################################################################
+
+class RingBufferSink:
+    '''
+    Keeps the last `maxlen` traces in memory.
+    '''
+
+    def __init__(self, maxlen=100):
+        self.traces = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def emit(self, trace):
+        with self._lock:
+            self.traces.append(trace)
+
+    def recent(self, n=None):
+        '''
+        Most recent traces first.
+        '''
+        with self._lock:
+            traces = list(self.traces)
+        traces.reverse()
+        return traces[:n] if n else traces
+
+class LoggingSink:
+    '''
+    Logs one line per trace with per-stage timings.
+    '''
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('memoir_rag.trace')
+        self.level = level
+
+    def emit(self, trace):
+        stages = ', '.join(f'{name}={ms:.1f}ms' for name, ms in trace.stage_durations().items())
+        self.logger.log(self.level, f"trace {trace.trace_id} {trace.name} {trace.duration_ms:.1f}ms [{stages}]")
+
+class JSONLSink:
+    '''
+    Appends each trace as one JSON line to a file.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, trace):
+        line = json.dumps(trace.to_dict(), default=str)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(line + '\n')
+
+# Always-on in-memory buffer of recent traces
+recent_traces = RingBufferSink()
+
+_sinks = [recent_traces]
+if os.environ.get('MEMOIR_TRACE') == 'log':
+    _sinks.append(LoggingSink())
+if os.environ.get('MEMOIR_TRACE_FILE'):
+    _sinks.append(JSONLSink(os.environ['MEMOIR_TRACE_FILE']))
+
+def add_sink(sink):
+    '''
+    Registers a sink; any object with an emit(trace) method works.
+    '''
+    _sinks.append(sink)
+
+def remove_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+################################################################################
+# Instrumentation API
+################################################################################
+
+@contextlib.contextmanager
+def start_trace(name, **attributes):
+    '''
+    Opens a trace for the enclosed block and emits it to the sinks on exit.
+    Nested calls reuse the outer trace.
+    '''
+    if _current_trace.get() is not None:
+        yield _current_trace.get()
+        return
+    trace = Trace(name, **attributes)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.attributes['error'] = repr(e)
+        raise
+    finally:
+        _current_trace.reset(token)
+        trace.duration_ms = trace.elapsed_ms()
+        for sink in list(_sinks):
+            try:
+                sink.emit(trace)
+            except Exception as e:
+                logging.error(f"Trace sink {sink!r} failed: {e}")
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    '''
+    Times the enclosed block as a stage of the current trace.
+    Does nothing outside a trace.
+    '''
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    record = {'name': name, 'start_ms': trace.elapsed_ms(), **attributes}
+    token = _current_span.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['duration_ms'] = (time.perf_counter() - start) * 1000
+        _current_span.reset(token)
+        trace.add_span(record)
+
+def annotate(**attributes):
+    '''
+    Sets attributes on the innermost open span, or on the trace itself.
+    '''
+    target = _current_span.get()
+    if target is None:
+        trace = _current_trace.get()
+        target = trace.attributes if trace is not None else None
+    if target is not None:
+        target.update(attributes)
+
+def record_usage(prompt_tokens=None, completion_tokens=None, cache_hit=False):
+    '''
+    Adds LLM token usage and cache-hit information to the current span and
+    to the trace totals.
+    '''
+    record = _current_span.get()
+    if record is not None:
+        record.update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, cache_hit=cache_hit)
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    with trace._lock:
+        totals = trace.attributes
+        totals['llm_calls'] = totals.get('llm_calls', 0) + (0 if cache_hit else 1)
+        totals['cache_hits'] = totals.get('cache_hits', 0) + (1 if cache_hit else 0)
+        totals['prompt_tokens'] = totals.get('prompt_tokens', 0) + (prompt_tokens or 0)
+        totals['completion_tokens'] = totals.get('completion_tokens', 0) + (completion_tokens or 0)
+
+def iterate_in_context(generator):
+    '''
+    Iterates a generator inside one private context, so traces and spans it
+    opens stay consistent no matter where the consumer resumes it from.
+    '''
+    context = contextvars.copy_context()
+    try:
+        while True:
+            try:
+                item = context.run(next, generator)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        context.run(generator.close)
@@ -0,0 +1,253 @@
+'''
+Local embedding index for semantic passage retrieval.
+
+Passage embeddings are stored in SQLite as float32 BLOBs next to the
+passages they describe, and searched with a vectorized cosine top-k in
+NumPy. Embeddings come from a local sentence-transformers model when one is
+configured with MEMOIR_EMBEDDING_MODEL and installed, and otherwise from a
+hashing embedder that needs no model download. NumPy is imported on first
+use so that importing this module stays cheap.
+'''
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from text import tokenize
+
+################################################################################
+# Embedders
+################################################################################
+
+class HashingEmbedder:
+    '''
+    Deterministic bag-of-words embedder using the hashing trick over word
+    unigrams and bigrams. Cheap, dependency-free, and good enough to match
+    paraphrases that share content words.
+    '''
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.name = f'hashing-{dim}'
+
+    def _bucket(self, feature):
+        digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest()
+        value = int.from_bytes(digest, 'little')
+        return value % self.dim, 1.0 if value >> 63 else -1.0
+
+    def embed(self, texts):
+        '''
+        Returns an (n, dim) float32 matrix of L2-normalized embeddings.
+        '''
+        import numpy as np
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            features = tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]
+            for feature in features:
+                index, sign = self._bucket(feature)
+                matrix[row, index] += sign
+        return _normalize(matrix)
+
+class SentenceTransformerEmbedder:
+    '''
+    Wraps a local sentence-transformers model running on the CPU.
+    '''
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.name = model_name
+
+    def embed(self, texts):
+        import numpy as np
+        matrix = self.model.encode(list(texts), convert_to_numpy=True)
+        return _normalize(matrix.astype(np.float32))
+
+def _normalize(matrix):
+    import numpy as np
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+_embedder = None
+
+def get_embedder():
+    '''
+    Returns the process-wide embedder, preferring the model named in
+    MEMOIR_EMBEDDING_MODEL and falling back to HashingEmbedder.
+    '''
+    global _embedder
+    if _embedder is None:
+        model_name = os.environ.get('MEMOIR_EMBEDDING_MODEL')
+        if model_name:
+            try:
+                _embedder = SentenceTransformerEmbedder(model_name)
+            except Exception as e:
+                logging.warning(f"Falling back to hashing embeddings: {e}")
+        if _embedder is None:
+            _embedder = HashingEmbedder()
+    return _embedder
+
+################################################################################
+# Storage and search
+################################################################################
+
+def add_embedding_table(conn):
+    '''
+    Creates the passage embedding table if it doesn't exist. Every stored
+    vector gets a new id, never reused, so MAX(id) changes whenever a
+    vector is written (see load_matrix).
+    '''
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS memoir_embeddings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            passage_id INTEGER UNIQUE,
+            memoir_id INTEGER,
+            chunk_id INTEGER,
+            model TEXT,
+            vector BLOB,
+            FOREIGN KEY (passage_id) REFERENCES memoir_passages (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS memoir_embeddings_memoir
+        ON memoir_embeddings (memoir_id, model)
+    ''')
+
+def update_embeddings(conn, memoir_id, embedder=None, batch_size=64, commit=True):
+    '''
+    Embeds passages of a memoir that have no embedding for the current model
+    and drops embeddings whose passage no longer exists.
+    Returns the number of passages embedded.
+    '''
+    embedder = embedder or get_embedder()
+    add_embedding_table(conn)
+    conn.execute('''
+        DELETE FROM memoir_embeddings
+        WHERE memoir_id = ?
+          AND (model != ? OR passage_id NOT IN (SELECT id FROM memoir_passages WHERE memoir_id = ?))
+    ''', (memoir_id, embedder.name, memoir_id))
+    # Embedded a batch at a time, so a large memoir is never held in memory
+    count, last_id = 0, 0
+    while True:
+        batch = conn.execute('''
+            SELECT id, chunk_id, content FROM memoir_passages
+            WHERE memoir_id = ? AND id > ?
+              AND id NOT IN (SELECT passage_id FROM memoir_embeddings WHERE memoir_id = ?)
+            ORDER BY id LIMIT ?
+        ''', (memoir_id, last_id, memoir_id, batch_size)).fetchall()
+        if not batch:
+            break
+        vectors = embedder.embed([content for _, _, content in batch])
+        conn.executemany('''
+            INSERT OR REPLACE INTO memoir_embeddings (passage_id, memoir_id, chunk_id, model, vector)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [
+            (passage_id, memoir_id, chunk_id, embedder.name, vector.tobytes())
+            for (passage_id, chunk_id, _), vector in zip(batch, vectors)
+        ])
+        count += len(batch)
+        last_id = batch[-1][0]
+    if commit:
+        conn.commit()
+    return count
+
+def delete_embeddings(conn, passage_query, params):
+    '''
+    Drops the embeddings of the passages selected by passage_query (a
+    SELECT of passage ids), before those passages are deleted. Passage ids
+    can be reused, so a vector must never outlive its passage.
+    '''
+    conn.execute(f'DELETE FROM memoir_embeddings WHERE passage_id IN ({passage_query})', params)
+
+# (database file, memoir_id, model) -> (version, passage ids, chunk ids,
+# matrix), least recently used first; version changes whenever
+# embeddings are written or removed
+_matrix_cache = OrderedDict()
+_matrix_lock = threading.Lock()
+
+# Matrices kept in memory at once, across memoirs and databases
+MAX_CACHED_MATRICES = 16
+
+def _database_key(conn):
+    '''
+    File of the connection's main database, so two databases never share
+    cached matrices. In-memory databases are told apart by connection.
+    '''
+    for _, name, path in conn.execute('PRAGMA database_list'):
+        if name == 'main':
+            return path or id(conn)
+    return id(conn)
+
+def load_matrix(conn, memoir_id, model):
+    '''
+    Returns (passage_ids, chunk_ids, matrix) for a memoir, reusing the
+    in-process copy while the stored embeddings are unchanged.
+    '''
+    import numpy as np
+    version = conn.execute('''
+        SELECT COUNT(*), MAX(id) FROM memoir_embeddings
+        WHERE memoir_id = ? AND model = ?
+    ''', (memoir_id, model)).fetchone()
+    key = (_database_key(conn), memoir_id, model)
+    with _matrix_lock:
+        cached = _matrix_cache.get(key)
+        if cached and cached[0] == version:
+            _matrix_cache.move_to_end(key)
+            return cached[1:]
+
+    rows = conn.execute('''
+        SELECT passage_id, chunk_id, vector FROM memoir_embeddings
+        WHERE memoir_id = ? AND model = ?
+        ORDER BY passage_id
+    ''', (memoir_id, model)).fetchall()
+    passage_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    chunk_ids = np.array([row[1] for row in rows], dtype=np.int64)
+    if rows:
+        matrix = np.vstack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+    else:
+        matrix = np.zeros((0, 0), dtype=np.float32)
+    with _matrix_lock:
+        _matrix_cache[key] = (version, passage_ids, chunk_ids, matrix)
+        _matrix_cache.move_to_end(key)
+        while len(_matrix_cache) > MAX_CACHED_MATRICES:
+            _matrix_cache.popitem(last=False)
+    return passage_ids, chunk_ids, matrix
+
+def search_vectors(conn, text, memoir_id, k=5, embedder=None):
+    '''
+    Cosine top-k passages for text. Returns [(passage_id, chunk_id, score)],
+    best first; empty if the memoir has no embeddings.
+    '''
+    import numpy as np
+    embedder = embedder or get_embedder()
+    try:
+        passage_ids, chunk_ids, matrix = load_matrix(conn, memoir_id, embedder.name)
+    except sqlite3.OperationalError:
+        # Database predates the embedding table
+        return []
+    if not len(passage_ids):
+        return []
+
+    query = embedder.embed([text])[0]
+    scores = matrix @ query
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [(int(passage_ids[i]), int(chunk_ids[i]), float(scores[i])) for i in top if scores[i] > 0]
+
+def reciprocal_rank_fusion(rankings, k=60):
+    '''
+    Fuses several best-first lists of ids into one, scoring each id by
+    the sum of 1 / (k + rank) over the lists it appears in.
+    Returns [(id, score)], best first.
+    '''
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda pair: pair[1], reverse=True)
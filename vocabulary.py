@@ -0,0 +1,188 @@
+'''
+Per-memoir vocabulary for turning questions into FTS queries locally.
+
+At ingest every memoir gets a table of the words, recurring bigrams and
+named entities ("Jones Beach", "Grand Central Parkway") in its chapters,
+with the number of chapters each appears in. Words are split the way the
+FTS5 unicode61 tokenizer splits them, so every vocabulary term is also a
+term of memoir_chunks_fts. A question is then matched against the
+vocabulary with one indexed query: phrases and words the memoir actually
+contains are kept, the rarest first, and everything else is dropped,
+which replaces the LLM keyword-extraction call for most questions.
+'''
+
+import math
+import re
+from collections import Counter
+
+from text import STOPWORDS, stem
+
+# Words as split by the FTS5 unicode61 tokenizer (letters and digits)
+FTS_TOKEN_PATTERN = re.compile(r'[^\W_]+')
+
+# Runs of two or more capitalized words on one line, e.g. "Grand Central Parkway"
+ENTITY_PATTERN = re.compile(r"\b[A-Z][a-z]+(?:'s)?(?:[ \t]+[A-Z][a-z]+)+\b")
+
+# What the tokenizer leaves of contractions ("we're" -> "we", "re")
+CONTRACTION_PARTS = frozenset(('s', 't', 're', 'll', 've', 'd', 'm'))
+
+# A bigram must occur this often in a memoir to enter its vocabulary
+MIN_BIGRAM_COUNT = 2
+
+# Phrases outweigh single words of the same rarity
+PHRASE_WEIGHT = 1.5
+
+def fts_tokens(text):
+    '''
+    Lowercased tokens of text, as the FTS index sees them.
+    '''
+    return FTS_TOKEN_PATTERN.findall(text.lower())
+
+def is_content_word(token):
+    return len(token) > 1 and token not in STOPWORDS and token not in CONTRACTION_PARTS
+
+def find_entities(text):
+    '''
+    Lowercased multi-word names in text. Leading stopwords ("When Alan
+    Plush") are dropped, and what remains must still be two words long.
+    Longer names also yield their word pairs, since they are often
+    shortened ("Grand Central Parkway", "Grand Central").
+    '''
+    entities = []
+    for match in ENTITY_PATTERN.finditer(text):
+        tokens = fts_tokens(match.group())
+        while tokens and tokens[0] in STOPWORDS:
+            tokens.pop(0)
+        if len(tokens) >= 2:
+            entities.append(' '.join(tokens))
+        if len(tokens) >= 3:
+            entities.extend(
+                f'{first} {second}' for first, second in zip(tokens, tokens[1:])
+                if is_content_word(first) and is_content_word(second)
+            )
+    return entities
+
+def chapter_terms(content):
+    '''
+    (word counts, bigram counts, entity counts) of one chapter.
+    '''
+    tokens = fts_tokens(content)
+    words = Counter(token for token in tokens if is_content_word(token))
+    bigrams = Counter(
+        f'{first} {second}' for first, second in zip(tokens, tokens[1:])
+        if is_content_word(first) and is_content_word(second)
+    )
+    return words, bigrams, Counter(find_entities(content))
+
+def add_vocabulary_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS memoir_vocabulary (
+            memoir_id INTEGER,
+            term TEXT,
+            kind TEXT,
+            stem TEXT,
+            doc_freq INTEGER,
+            term_freq INTEGER,
+            PRIMARY KEY (memoir_id, term),
+            FOREIGN KEY (memoir_id) REFERENCES memoirs (id)
+        ) WITHOUT ROWID
+    ''')
+    # Covers the stem lookup of extract_local_keywords
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS memoir_vocabulary_stem
+        ON memoir_vocabulary (memoir_id, stem, kind, doc_freq)
+    ''')
+
+def build_vocabulary(conn, memoir_id):
+    '''
+    Rebuilds a memoir's vocabulary from its chapters, one chapter at a
+    time. Does not commit. Returns the number of terms.
+    '''
+    doc_freq, term_freq, kinds = Counter(), Counter(), {}
+    for (content,) in conn.execute('SELECT content FROM memoir_chunks WHERE memoir_id = ?', (memoir_id,)):
+        words, bigrams, entities = chapter_terms(content)
+        # A bigram that is also a name is kept as the name
+        counts = {term: ('word', count) for term, count in words.items()}
+        counts.update((term, ('bigram', count)) for term, count in bigrams.items())
+        counts.update((term, ('entity', max(count, bigrams[term]))) for term, count in entities.items())
+        for term, (kind, count) in counts.items():
+            doc_freq[term] += 1
+            term_freq[term] += count
+            if kinds.get(term) != 'entity':
+                kinds[term] = kind
+
+    conn.execute('DELETE FROM memoir_vocabulary WHERE memoir_id = ?', (memoir_id,))
+    rows = [
+        (memoir_id, term, kind, stem(term) if kind == 'word' else None, doc_freq[term], term_freq[term])
+        for term, kind in kinds.items()
+        if kind != 'bigram' or term_freq[term] >= MIN_BIGRAM_COUNT
+    ]
+    conn.executemany('''
+        INSERT INTO memoir_vocabulary (memoir_id, term, kind, stem, doc_freq, term_freq)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', rows)
+    return len(rows)
+
+def idf(doc_freq, chapters):
+    '''
+    bm25's inverse document frequency: rarer terms weigh more.
+    '''
+    return math.log((chapters - doc_freq + 0.5) / (doc_freq + 0.5) + 1)
+
+def extract_local_keywords(conn, memoir_id, text, max_terms=8):
+    '''
+    Search terms for a question, taken from the memoir's vocabulary: its
+    names and bigrams as phrases, and its words. A word missing from the
+    memoir is replaced by the memoir's words sharing its stem, so "jobs"
+    finds "job". Words found in every chapter are left out when rarer terms
+    are found. Returns an empty list when no word of the question occurs in
+    the memoir.
+
+    Terms are weighted by idf (phrases count extra) only to choose the
+    max_terms that are kept and their order; the weights are not passed
+    on, since bm25 weighs the terms of the FTS query by rarity itself.
+    '''
+    tokens = fts_tokens(text)
+    words = [token for token in tokens if is_content_word(token)]
+    if not words:
+        return []
+    phrases = {
+        ' '.join(tokens[start:start + size])
+        for size in (2, 3, 4)
+        for start in range(len(tokens) - size + 1)
+        if is_content_word(tokens[start]) and is_content_word(tokens[start + size - 1])
+    }
+    stems = {stem(word) for word in words}
+
+    candidates = list(dict.fromkeys(words)) + sorted(phrases)
+    term_marks = ','.join('?' for _ in candidates)
+    stem_marks = ','.join('?' for _ in stems)
+    rows = conn.execute(f'''
+        SELECT term, kind, doc_freq FROM memoir_vocabulary
+        WHERE memoir_id = ? AND term IN ({term_marks})
+        UNION
+        SELECT term, kind, doc_freq FROM memoir_vocabulary
+        WHERE memoir_id = ? AND stem IN ({stem_marks})
+    ''', (memoir_id, *candidates, memoir_id, *stems)).fetchall()
+    if not rows:
+        return []
+
+    exact = {term for term, _, _ in rows}
+    missing_stems = {stem(word) for word in words if word not in exact}
+    rows = [
+        (term, kind, doc_freq) for term, kind, doc_freq in rows
+        if term in candidates or stem(term) in missing_stems
+    ]
+    if not rows:
+        return []
+
+    chapters = conn.execute(
+        'SELECT COUNT(*) FROM memoir_chunks WHERE memoir_id = ?', (memoir_id,)
+    ).fetchone()[0]
+    if any(doc_freq < chapters for _, _, doc_freq in rows):
+        rows = [row for row in rows if row[1] != 'word' or row[2] < chapters]
+    weights = {
+        term: idf(doc_freq, chapters) * (1.0 if kind == 'word' else PHRASE_WEIGHT)
+        for term, kind, doc_freq in rows
+    }
+    return sorted(weights, key=lambda term: -weights[term])[:max_terms]